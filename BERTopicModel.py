@@ -3,6 +3,8 @@ import openai
 from bertopic.backend import OpenAIBackend
 from bertopic import BERTopic
 from TopicModelingInterface import TopicModelingInterface
+from embedding_store import EmbeddingStore
+from phases import phase
 from dotenv import load_dotenv
 
 load_dotenv(".env")
@@ -13,6 +15,12 @@ class BERTopicModel(TopicModelingInterface):
         API_KEY = os.getenv("OPENAI_KEY")
         client = openai.OpenAI(api_key=API_KEY)
         self.embedding_model = OpenAIBackend(client, "text-embedding-3-large")
+        # runs sample overlapping documents, so embeddings are reused across runs
+        self.embedding_store = EmbeddingStore.open(
+            config.get("EMBEDDING_STORE_DIR", "cache/embeddings"),
+            "text-embedding-3-large",
+            quantize=config.get("EMBEDDING_STORE_INT8", False),
+        )
 
     def fit_transform(self, documents):
         model = BERTopic(
@@ -20,7 +28,10 @@ class BERTopicModel(TopicModelingInterface):
             nr_topics=self.n_topics,
             min_topic_size=2,
         )
-        topics, _ = model.fit_transform(documents)
+        with phase("embedding"):
+            embeddings = self.embedding_store.embed(documents, self.embedding_model.embed)
+        with phase("fit"):
+            topics, _ = model.fit_transform(documents, embeddings=embeddings)
         # obtain topic names
         topic_name_mapping = model.get_topic_info()['Name']
         if min(topics) < 0:
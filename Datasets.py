@@ -1,42 +1,199 @@
+import json
+import os
+import threading
+
+import numpy as np
 import pandas as pd
 
-class NYTDataset:
-    def __init__(self):
-        self.df = pd.read_csv('data_in/ny_times_articles.csv')
-        self.data = self.df['abstract'].tolist()
-        idx_mapping = {x: i for i, x in enumerate(self.df['keyword'].unique())}
-        self.target = [idx_mapping[x] for x in self.df['keyword']]
-        self.target_names = {i: x for i, x in enumerate(self.df['keyword'].unique())}
-
-class ArXivDataset:
-    def __init__(self):
-        self.df = pd.read_csv('data_in/arxiv_articles.csv')
-        self.data = self.df['Summary'].tolist()
-        idx_mapping = {x: i for i, x in enumerate(self.df['Category'].unique())}
-        self.target = [idx_mapping[x] for x in self.df['Category']]
-        self.target_names = {i: x for i, x in enumerate(self.df['Category'].unique())}
-        
-class PubmedDataset:
-    def __init__(self):
-        self.df = pd.read_csv('data_in/pubmed_articles.csv')
-        self.data = self.df['abstract'].tolist()
-        idx_mapping = {x: i for i, x in enumerate(self.df['mesh_subheading'].unique())}
-        self.target = [idx_mapping[x] for x in self.df['mesh_subheading']]
-        self.target_names = {i: x for i, x in enumerate(self.df['mesh_subheading'].unique())}
+from Auxiliary import logger
+
+
+class TextColumn:
+    """Read-only sequence of documents stored as one UTF-8 buffer and the offsets of each document."""
+
+    def __init__(self, buffer, offsets):
+        self.buffer = buffer
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.buffer[start:end].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    @classmethod
+    def from_texts(cls, texts):
+        encoded = [text.encode("utf-8") for text in texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+
+class ColumnarDataset:
+    """A dataset with the same attributes as the scikit-learn bunches: data, target and target_names.
+
+    `data` is a `TextColumn`, `target` an int32 array of label ids and `target_names`
+    the label of each id. `path` is the source CSV, if there is one.
+    """
+
+    def __init__(self, name, data, target, target_names, path=None):
+        self.name = name
+        self.data = data
+        self.target = target
+        self.target_names = target_names
+        self.path = path
+
+    def save(self, directory, source):
+        os.makedirs(directory, exist_ok=True)
+        for key, array in (
+            ("buffer", self.data.buffer),
+            ("offsets", self.data.offsets),
+            ("target", self.target),
+        ):
+            path = os.path.join(directory, f"{key}.npy")
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, array)
+            os.replace(path + ".tmp", path)
+        # the metadata is written last, so a cache without it is incomplete
+        meta_path = os.path.join(directory, "meta.json")
+        with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"source": source, "target_names": list(self.target_names)}, f)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    @classmethod
+    def load(cls, name, directory, source, path=None):
+        """Returns the cached dataset, or None if it is missing or was built from another source.
+
+        The arrays are memory-mapped, so processes that load the same dataset share its pages.
+        """
+        meta_path = os.path.join(directory, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["source"] != source:
+            return None
+        arrays = {
+            key: np.load(os.path.join(directory, f"{key}.npy"), mmap_mode="r")
+            for key in ("buffer", "offsets", "target")
+        }
+        return cls(
+            name,
+            TextColumn(arrays["buffer"], arrays["offsets"]),
+            arrays["target"],
+            meta["target_names"],
+            path=path,
+        )
+
+
+class CSVDatasetSpec:
+    """A dataset stored as a CSV file, of which only the text and label columns are read."""
+
+    def __init__(self, path, text_column, label_column):
+        self.path = path
+        self.text_column = text_column
+        self.label_column = label_column
+
+    def source(self):
+        stat = os.stat(self.path)
+        return {"path": self.path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def read(self, name):
+        df = pd.read_csv(self.path, usecols=[self.text_column, self.label_column])
+        # label ids follow the order of first appearance, like the former dataset classes;
+        # documents without a label form their own class instead of getting id -1
+        target, target_names = pd.factorize(df[self.label_column], use_na_sentinel=False)
+        texts = df[self.text_column].fillna("").astype(str)
+        return ColumnarDataset(
+            name,
+            TextColumn.from_texts(texts),
+            target.astype(np.int32),
+            [str(label) for label in target_names],
+            path=self.path,
+        )
+
+
+class NewsgroupsSpec:
+    """The training split of 20 Newsgroups from scikit-learn, without headers, footers and quotes."""
+
+    path = None
+
+    def source(self):
+        return {"sklearn": "20newsgroups", "subset": "train", "remove": ["headers", "footers", "quotes"]}
+
+    def read(self, name):
+        from sklearn.datasets import fetch_20newsgroups
+
+        bunch = fetch_20newsgroups(subset="train", remove=("headers", "footers", "quotes"))
+        return ColumnarDataset(
+            name,
+            TextColumn.from_texts(bunch.data),
+            np.asarray(bunch.target, dtype=np.int32),
+            list(bunch.target_names),
+        )
+
+
+DATASETS = {
+    "NYT": CSVDatasetSpec("data_in/ny_times_articles.csv", "abstract", "keyword"),
+    "ARXIV": CSVDatasetSpec("data_in/arxiv_articles.csv", "Summary", "Category"),
+    "PUBMED": CSVDatasetSpec("data_in/pubmed_articles.csv", "abstract", "mesh_subheading"),
+    "NEWSGROUPS": NewsgroupsSpec(),
+}
+# unknown dataset names fall back to 20 Newsgroups, as they always have
+DEFAULT_DATASET = "NEWSGROUPS"
+
+_loaded = {}
+_lock = threading.Lock()
+
+
+def register_dataset(name, spec):
+    """Make a dataset available as config["DATASET"] = name; `spec` is e.g. a CSVDatasetSpec."""
+    DATASETS[name] = spec
+
+
+def load_dataset(name, cache_dir="data_in"):
+    """This function returns a dataset, loading it at most once per process.
+
+    The first load in any process converts the source into a columnar cache in
+    `cache_dir`; later processes memory-map that cache instead of parsing the source.
+    """
+    if name not in DATASETS:
+        name = DEFAULT_DATASET
+    with _lock:
+        if name not in _loaded:
+            spec = DATASETS[name]
+            directory = os.path.join(cache_dir, f"{name.lower()}.columns")
+            source = spec.source()
+            dataset = ColumnarDataset.load(name, directory, source, path=spec.path)
+            if dataset is None:
+                logger.info(f"Building columnar cache of {name} in {directory}")
+                spec.read(name).save(directory, source)
+                dataset = ColumnarDataset.load(name, directory, source, path=spec.path)
+            _loaded[name] = dataset
+        return _loaded[name]
 
 
 def get_nyt():
-    return NYTDataset()
+    return load_dataset("NYT")
 
 def get_arxiv():
-    return ArXivDataset()
+    return load_dataset("ARXIV")
 
 def get_pubmed():
-    return PubmedDataset()
+    return load_dataset("PUBMED")
 
 
 
 if __name__ == '__main__':
     arxiv = get_arxiv()
     nytimes = get_nyt()
-    print(nytimes.target_names)
\ No newline at end of file
+    print(nytimes.target_names)
@@ -1,14 +1,19 @@
 from TopicModelingInterface import TopicModelingInterface
-import tiktoken
 from genai_functions import (
     complete_openai_request,
-    chunk_documents,
+    pack_documents,
     topic_creation_prompt,
     topic_elimination_prompt,
-    topic_classification_prompt,
+    topic_elimination_round_prompt,
     complete_openai_request_parralel,
+    configure_backend_from_config,
+    configure_throughput_from_config,
+    classify_documents,
+    topic_probabilities,
 )
 from itertools import chain
+from phases import phase
+from checkpoints import PhaseCheckpoint
 import random
 import json
 
@@ -17,90 +22,170 @@ class GenAIMethod(TopicModelingInterface):
     def __init__(self, config):
         super().__init__(config)
         self.model = config["MODEL"]
+        # soft assignments of the last fit_transform: (n_docs, n_topics) probabilities and their maximum
+        self.doc_topic_matrix = None
+        self.topic_confidences = None
+        configure_throughput_from_config(config)
+        configure_backend_from_config(config)
+        # "pairwise" merges one pair per request, "rounds" proposes several disjoint merges per request
+        self.elimination_mode = config.get("ELIMINATION_MODE", "pairwise")
+        self.max_merges_per_round = config.get("MAX_MERGES_PER_ROUND")
 
     def fit_transform(self, documents):
-        enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        encoding_function = lambda x: enc.encode(x)
-        decoding_function = lambda x: enc.decode(x)
-        
-        chunks = chunk_documents(
-            documents,
-            encoding_function,
-            decoding_function,
-            self.token_limit,
-            max_documents=self.n_documents // 8,
-        )
-
-        prompts = [topic_creation_prompt(chunk) for chunk in chunks]
-        results = complete_openai_request_parralel(
-            prompts, model=self.model, timeout=30, batch_size=10
-        )
-        topic_list = list(
-            chain(
-                *[
-                    result["topics"]
-                    for result in results
-                    if result and isinstance(result, dict) and "topics" in result
-                ]
+        checkpoint = PhaseCheckpoint.for_run(self.__class__.__name__, self.config, documents)
+        results = checkpoint.load("chunk_topics")
+        if results is None:
+            with phase("chunking"):
+                import tiktoken
+
+                enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
+
+                chunks = pack_documents(
+                    documents,
+                    enc,
+                    self.token_limit,
+                    max_documents=self.n_documents // 8,
+                    keep_order=self.config.get("CHUNK_KEEP_ORDER", False),
+                )
+
+            with phase("topic_generation"):
+                prompts = [topic_creation_prompt(chunk) for chunk in chunks]
+                results = checkpoint.save(
+                    "chunk_topics",
+                    complete_openai_request_parralel(prompts, model=self.model, timeout=30),
+                )
+
+        topic_list = checkpoint.load("candidate_topics")
+        if topic_list is None:
+            topic_list = list(
+                chain(
+                    *[
+                        result["topics"]
+                        for result in results
+                        if result and isinstance(result, dict) and "topics" in result
+                    ]
+                )
             )
-        )
-        topic_list = [x.lower() for x in topic_list]
-        topic_list = list(set(topic_list))
-        
-        history = []
-        # Initialize the history with the original topic list
-        history.append({
-            "step": 0,
-            "topics": topic_list[:],
-            "parents": {topic: None for topic in topic_list}
-        })
-        step = 1
-                
-        while len(topic_list) > self.n_topics:
-            prompt = topic_elimination_prompt(topic_list)
-            response = complete_openai_request(prompt, model=self.model)
-            elimated_topics = [topic_list[i].lower() for i in response["topic_pair"]]
-            old_topic_list = topic_list[:]
-            new_topic = response["new_topic"].lower()
-            try:
-                if len(elimated_topics) != 2:
-                    raise Exception("Invalid number of topics to eliminate")
-                topic_list.remove(elimated_topics[0])
-                topic_list.remove(elimated_topics[1])
-                topic_list.append(new_topic)
-                print(f"Eliminated {elimated_topics} and added {response['new_topic']}")
-                print(f"Step {step}, steps to go: {len(topic_list) - self.n_topics}")
-                
-                # Create the parents dictionary for the current step
-                current_parents = {topic: [topic] for topic in topic_list}
-                current_parents[new_topic] = elimated_topics
-                
-                # Add the new state to history
+            topic_list = [x.lower() for x in topic_list]
+            # set order differs between processes, so the deduplicated list is saved as well
+            topic_list = checkpoint.save("candidate_topics", list(set(topic_list)))
+
+        with phase("elimination"):
+            # the history is saved after every merge, so a restarted run continues from the last one
+            history = checkpoint.load("elimination_history")
+            if history:
+                topic_list = history[-1]["topics"][:]
+                step = history[-1]["step"] + 1
+            else:
+                history = []
+                # Initialize the history with the original topic list
                 history.append({
-                    "step": step,
+                    "step": 0,
                     "topics": topic_list[:],
-                    "parents": current_parents
+                    "parents": {topic: None for topic in topic_list}
                 })
-                step += 1
-            except Exception as e:
-                topic_list = old_topic_list
-                random.shuffle(topic_list)
-                
+                step = 1
+
+            while len(topic_list) > self.n_topics:
+                if self.elimination_mode == "rounds":
+                    merges = self.propose_merge_round(topic_list)
+                    if merges:
+                        for elimated_topics, new_topic in merges:
+                            topic_list = self.apply_merge(
+                                topic_list, elimated_topics, new_topic, history, step
+                            )
+                            step += 1
+                        checkpoint.save("elimination_history", history)
+                        continue
+                    print("Invalid merge round, falling back to a single merge")
+
+                prompt = topic_elimination_prompt(topic_list)
+                response = complete_openai_request(prompt, model=self.model)
+                old_topic_list = topic_list[:]
+                try:
+                    elimated_topics = [topic_list[i].lower() for i in response["topic_pair"]]
+                    new_topic = response["new_topic"].lower()
+                    if len(elimated_topics) != 2:
+                        raise Exception("Invalid number of topics to eliminate")
+                    topic_list = self.apply_merge(
+                        topic_list, elimated_topics, new_topic, history, step
+                    )
+                    step += 1
+                    checkpoint.save("elimination_history", history)
+                except Exception as e:
+                    topic_list = old_topic_list
+                    random.shuffle(topic_list)
+
         # Save the history to a JSON file
         with open('topic_history.json', 'w') as f:
             json.dump(history, f, indent=4)
 
-        prompts = [
-            topic_classification_prompt(document, topic_list) for document in documents
-        ]
-        results = complete_openai_request_parralel(
-            prompts, model=self.model, timeout=30, batch_size=50
-        )
-
-        topic_assignments = [self.assign_topic(result) for result in results]
+        with phase("classification"):
+            results = checkpoint.map_batches(
+                "classification",
+                documents,
+                lambda batch: classify_documents(batch, topic_list, self.model, self.config),
+                batch_size=self.config.get("CHECKPOINT_BATCH_SIZE", 500),
+                # a bulk job per batch would run one after the other
+                single_call=self.config.get("LLM_BACKEND", "online") != "online",
+            )
+            topic_assignments = [self.assign_topic(result) for result in results]
+        self.doc_topic_matrix = topic_probabilities(results, topic_assignments, self.n_topics)
+        self.topic_confidences = self.doc_topic_matrix.max(axis=1)
         topic_names = [topic_list[i] if i >= 0 else "ERROR_NO_TOPIC" for i in topic_assignments]
         return topic_assignments, topic_names, self.n_topics
 
+    def apply_merge(self, topic_list, elimated_topics, new_topic, history, step):
+        topic_list = topic_list[:]
+        topic_list.remove(elimated_topics[0])
+        topic_list.remove(elimated_topics[1])
+        topic_list.append(new_topic)
+        print(f"Eliminated {elimated_topics} and added {new_topic}")
+        print(f"Step {step}, steps to go: {len(topic_list) - self.n_topics}")
+
+        # Create the parents dictionary for the current step
+        current_parents = {topic: [topic] for topic in topic_list}
+        current_parents[new_topic] = elimated_topics
+
+        # Add the new state to history
+        history.append({
+            "step": step,
+            "topics": topic_list[:],
+            "parents": current_parents
+        })
+        return topic_list
+
+    def propose_merge_round(self, topic_list):
+        """Ask for up to M disjoint merges in one request; returns None if the answer is invalid.
+
+        M defaults to a quarter of the current list, so the number of rounds grows with
+        log(N) instead of N, and is capped so the list never drops below n_topics.
+        """
+        max_merges = self.max_merges_per_round or max(1, len(topic_list) // 4)
+        max_merges = min(max_merges, len(topic_list) - self.n_topics, len(topic_list) // 2)
+        prompt = topic_elimination_round_prompt(topic_list, max_merges)
+        response = complete_openai_request(prompt, model=self.model)
+        try:
+            merges = []
+            used = set()
+            for merge in response["merges"][:max_merges]:
+                pair = merge["topic_pair"]
+                if (
+                    len(pair) != 2
+                    or not all(isinstance(i, int) and 0 <= i < len(topic_list) for i in pair)
+                    or pair[0] == pair[1]
+                    or used.intersection(pair)
+                ):
+                    raise ValueError(f"Invalid topic pair {pair}")
+                used.update(pair)
+                merges.append(
+                    ([topic_list[i] for i in pair], str(merge["new_topic"]).lower())
+                )
+            return merges
+        except Exception as e:
+            print(e)
+            return None
+
     def assign_topic(self, result):
         if result is None:
             return -3
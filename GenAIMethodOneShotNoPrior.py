@@ -1,88 +1,124 @@
 from TopicModelingInterface import TopicModelingInterface
-import tiktoken
 from genai_functions import (
     complete_openai_request,
-    chunk_documents,
+    pack_documents,
     topic_creation_prompt,
     topic_elimination_prompt,
-    topic_classification_prompt,
     complete_openai_request_parralel,
+    configure_backend_from_config,
+    configure_throughput_from_config,
+    classify_documents,
+    topic_probabilities,
+    repair_classifications,
     topic_combination_prompt_noprior,
 )
 from itertools import chain
+from phases import phase
+from checkpoints import PhaseCheckpoint
 import random
 
 class GenAIMethodOneShotNoPrior(TopicModelingInterface):
     def __init__(self, config):
         super().__init__(config)
         self.model = config["MODEL"]
+        # soft assignments of the last fit_transform: (n_docs, n_topics) probabilities and their maximum
+        self.doc_topic_matrix = None
+        self.topic_confidences = None
+        self.repair_log = []
+        configure_throughput_from_config(config)
+        configure_backend_from_config(config)
 
     def fit_transform(self, documents):
-        enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        encoding_function = lambda x: enc.encode(x)
-        decoding_function = lambda x: enc.decode(x)
+        checkpoint = PhaseCheckpoint.for_run(self.__class__.__name__, self.config, documents)
+        results = checkpoint.load("chunk_topics")
+        if results is None:
+            with phase("chunking"):
+                import tiktoken
 
-        chunks = chunk_documents(
-            documents,
-            encoding_function,
-            decoding_function,
-            self.token_limit,
-            max_documents=self.n_documents // 8,
-        )
+                enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
 
-        prompts = [topic_creation_prompt(chunk) for chunk in chunks]
-        results = complete_openai_request_parralel(
-            prompts, model=self.model, timeout=30, batch_size=10
-        )
-        topic_list = list(
-            chain(
-                *[
-                    result["topics"]
-                    for result in results
-                    if result and isinstance(result, dict) and "topics" in result
-                ]
+                chunks = pack_documents(
+                    documents,
+                    enc,
+                    self.token_limit,
+                    max_documents=self.n_documents // 8,
+                    keep_order=self.config.get("CHUNK_KEEP_ORDER", False),
+                )
+
+            with phase("topic_generation"):
+                prompts = [topic_creation_prompt(chunk) for chunk in chunks]
+                results = checkpoint.save(
+                    "chunk_topics",
+                    complete_openai_request_parralel(prompts, model=self.model, timeout=30),
+                )
+
+        topic_list = checkpoint.load("candidate_topics")
+        if topic_list is None:
+            topic_list = list(
+                chain(
+                    *[
+                        result["topics"]
+                        for result in results
+                        if result and isinstance(result, dict) and "topics" in result
+                    ]
+                )
             )
-        )
-        topic_list = [x.lower() for x in topic_list]
-        topic_list = list(set(topic_list))
+            topic_list = [x.lower() for x in topic_list]
+            # set order differs between processes, so the deduplicated list is saved as well
+            topic_list = checkpoint.save("candidate_topics", list(set(topic_list)))
 
-        prompt = topic_combination_prompt_noprior(topic_list)
-        print("starting topic combination")
-        finished = False
-        for _ in range(10):
-            try:
-                topic_list = complete_openai_request(prompt)["topics"][: self.n_topics]
-                finished = True
-                break
-            except Exception as e:
-                random.shuffle(topic_list)
+        combined = checkpoint.load("combined_topics")
+        if combined is not None:
+            topic_list = combined
+        else:
+            with phase("combination"):
                 prompt = topic_combination_prompt_noprior(topic_list)
-                print(e)
-                print("retrying")
-                continue
-        if not finished:
-            print("failed to finish topic combination")
-            exit(1)
-        print("finished topic combination")
+                print("starting topic combination")
+                finished = False
+                for _ in range(10):
+                    try:
+                        topic_list = complete_openai_request(prompt)["topics"][: self.n_topics]
+                        finished = True
+                        break
+                    except Exception as e:
+                        random.shuffle(topic_list)
+                        prompt = topic_combination_prompt_noprior(topic_list)
+                        print(e)
+                        print("retrying")
+                        continue
+                if not finished:
+                    print("failed to finish topic combination")
+                    exit(1)
+                print("finished topic combination")
+            checkpoint.save("combined_topics", topic_list)
         self.n_topics = len(topic_list)
-        prompts = [
-            topic_classification_prompt(document, topic_list) for document in documents
-        ]
-        results = complete_openai_request_parralel(
-            prompts, model=self.model, timeout=30, batch_size=100
-        )
-        topic_assignments = [self.assign_topic(result) for result in results]
-        for _ in range(10):
-            for i in range(len(topic_assignments)):
-                if topic_assignments[i] < 0:
-                    print(f"Error in document {i}")
-                    # retry with higher temperature
-                    result = complete_openai_request(prompts[i], temperature=0.7)
-                    print(f"Old result: {results[i]}")
-                    topic_assignments[i] = self.assign_topic(result)
-                    print(f"New result: {result}")
-            if all([x >= 0 for x in topic_assignments]):
-                break
+        with phase("classification"):
+            results = checkpoint.map_batches(
+                "classification",
+                documents,
+                lambda batch: classify_documents(batch, topic_list, self.model, self.config),
+                batch_size=self.config.get("CHECKPOINT_BATCH_SIZE", 500),
+                # a bulk job per batch would run one after the other
+                single_call=self.config.get("LLM_BACKEND", "online") != "online",
+            )
+            topic_assignments = [self.assign_topic(result) for result in results]
+        repaired = checkpoint.load("repair")
+        if repaired is not None:
+            topic_assignments, self.repair_log = repaired["assignments"], repaired["log"]
+        else:
+            with phase("repair"):
+                topic_assignments, self.repair_log = repair_classifications(
+                    documents,
+                    topic_list,
+                    topic_assignments,
+                    self.assign_topic,
+                    self.model,
+                    max_attempts=self.config.get("REPAIR_ATTEMPTS", 3),
+                    temperatures=self.config.get("REPAIR_TEMPERATURES", (0.3, 0.7, 1.0)),
+                )
+            checkpoint.save("repair", {"assignments": topic_assignments, "log": self.repair_log})
+        self.doc_topic_matrix = topic_probabilities(results, topic_assignments, self.n_topics)
+        self.topic_confidences = self.doc_topic_matrix.max(axis=1)
         topic_names = [
             topic_list[i] if i >= 0 else "ERROR_NO_TOPIC" for i in topic_assignments
         ]
@@ -1,10 +1,10 @@
+import numpy as np
 from gensim import corpora
 from gensim.models import LdaModel
-from gensim.parsing.preprocessing import STOPWORDS
-from gensim.utils import simple_preprocess
 from gensim.models.phrases import Phrases, Phraser
-from nltk.stem import WordNetLemmatizer
 from TopicModelingInterface import TopicModelingInterface
+from phases import phase
+from text_preprocessing import preprocess_corpus
 
 class LDAGensimModel(TopicModelingInterface):
     def __init__(self, config):
@@ -13,57 +13,62 @@ class LDAGensimModel(TopicModelingInterface):
         self.lda_model = None
         self.bigram = None
         self.trigram = None
-        self.lemmatizer = WordNetLemmatizer()
+        # (n_docs, n_topics) topic distributions of the last fit_transform and their maximum
+        self.doc_topic_matrix = None
+        self.topic_confidences = None
 
     def preprocess(self, texts):
-        # Tokenize
-        texts = [simple_preprocess(text) for text in texts]
-        
-        # Remove stopwords
-        texts = [[word for word in doc if word not in STOPWORDS] for doc in texts]
-        # Lemmatize
-        texts = [[self.lemmatizer.lemmatize(word) for word in doc] for doc in texts]
-        
-        return texts
+        # Tokenize, remove stopwords and lemmatize in one pass, reusing stored token lists
+        return preprocess_corpus(
+            texts,
+            store_path=self.config.get("LDA_TOKEN_STORE", "cache/lda_tokens.sqlite"),
+            processes=self.config.get("LDA_PREPROCESS_PROCESSES"),
+        )
 
     def fit_transform(self, documents):
-        # Preprocess the documents
-        processed_docs = self.preprocess(documents)
+        with phase("preprocess"):
+            # Preprocess the documents
+            processed_docs = self.preprocess(documents)
 
-        # Create Dictionary
-        self.dictionary = corpora.Dictionary(processed_docs)
-        self.dictionary.filter_extremes(keep_n=1_000)
+        with phase("fit"):
+            # Create Dictionary
+            self.dictionary = corpora.Dictionary(processed_docs)
+            self.dictionary.filter_extremes(keep_n=1_000)
 
-        # Create Corpus
-        corpus = [self.dictionary.doc2bow(doc) for doc in processed_docs]
+            # Create Corpus
+            corpus = [self.dictionary.doc2bow(doc) for doc in processed_docs]
 
-        # Train LDA model
-        self.lda_model = LdaModel(
-            corpus=corpus,
-            id2word=self.dictionary,
-            num_topics=self.config["N_TOPICS"],
-            random_state=self.config["SEED"],
-            alpha='auto',
-            eta='auto',
-        )
+            # Train LDA model
+            self.lda_model = LdaModel(
+                corpus=corpus,
+                id2word=self.dictionary,
+                num_topics=self.config["N_TOPICS"],
+                random_state=self.config["SEED"],
+                alpha='auto',
+                eta='auto',
+            )
 
-        # Assign topics to documents
-        topics = []
-        topic_names = []
-        for doc in corpus:
-            topic_dist = self.lda_model.get_document_topics(doc)
-            dominant_topic = max(topic_dist, key=lambda x: x[1])[0]
-            topics.append(dominant_topic)
-            
-            # Get topic name (top 4 words)
-            topic_words = self.lda_model.show_topic(dominant_topic, topn=4)
-            topic_name = " ".join([word for word, _ in topic_words])
-            topic_names.append(topic_name)
+        with phase("assign"):
+            # Infer the topic distributions of all documents in one batched E-step
+            gamma, _ = self.lda_model.inference(corpus)
+            self.doc_topic_matrix = (gamma / gamma.sum(axis=1, keepdims=True)).astype(np.float32)
+            self.topic_confidences = self.doc_topic_matrix.max(axis=1)
+            topics = self.doc_topic_matrix.argmax(axis=1).tolist()
+
+            # Name each topic once by its top 4 words
+            topic_labels = self.topic_labels(topn=4)
+            topic_names = [topic_labels[topic] for topic in topics]
 
         num_topics = self.lda_model.num_topics
 
         return topics, topic_names, num_topics
 
+    def topic_labels(self, topn=4):
+        """Returns the name of every topic: its `topn` most probable words."""
+        topic_word = self.lda_model.get_topics()
+        top = np.argsort(-topic_word, axis=1)[:, :topn]
+        return [" ".join(self.dictionary[i] for i in row) for row in top]
+
     def get_topic_words(self, num_words=10):
         return {i: [word for word, _ in self.lda_model.show_topic(i, topn=num_words)] for i in range(self.lda_model.num_topics)}
 
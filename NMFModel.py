@@ -1,33 +1,152 @@
 from TopicModelingInterface import TopicModelingInterface
 from sklearn.decomposition import NMF
 from sklearn.feature_extraction.text import TfidfVectorizer
+from concurrent.futures import ProcessPoolExecutor
+import os
 import numpy as np
+from phases import phase
+
+# fewest topic counts fitted one after the other in a sweep, so most fits are warm-started
+MIN_SEGMENT_SIZE = 3
+
 
 class NMFModel(TopicModelingInterface):
     def __init__(self, config):
         super().__init__(config)
 
+    def vectorize(self, documents, dtype=np.float64):
+        tfidf_vectorizer = TfidfVectorizer(max_df=0.95, min_df=2, max_features=self.config["N_FEATURES"], stop_words='english', dtype=dtype)
+        tfidf = tfidf_vectorizer.fit_transform(documents)
+        return tfidf, tfidf_vectorizer.get_feature_names_out()
+
     def fit_transform(self, documents):
         # Train the NMF model
-        tfidf_vectorizer = TfidfVectorizer(max_df=0.95, min_df=2, max_features=self.config["N_FEATURES"], stop_words='english')
-        tfidf = tfidf_vectorizer.fit_transform(documents)
-        nmf = NMF(n_components=self.config["N_TOPICS"], random_state=self.config["SEED"]).fit(tfidf)
-        # Assign topics to documents
-        topic_distribution = nmf.transform(tfidf)
-        topics = np.argmax(topic_distribution, axis=1)  # Get the index of the highest contribution topic for each document
-        num_topics = len(set(topics))
-                
-        # Assign names to topics based on top words
-        feature_names = tfidf_vectorizer.get_feature_names_out()
-        top_words_per_topic = []
-        for topic_idx, topic in enumerate(nmf.components_):
-            top_words = [feature_names[i] for i in topic.argsort()[:-4:-1]]  # Get the top 4 words for this topic
-            top_words_per_topic.append(" ".join(top_words))
-
-        # Create a mapping from integer to topic name
-        topic_name_mapping = {i: name for i, name in enumerate(top_words_per_topic)}
-
-        # Create the list of topic names for each document
-        topic_names = [topic_name_mapping[topic] for topic in topics]
-        
-        return topics, topic_names, num_topics
\ No newline at end of file
+        with phase("vectorize"):
+            tfidf, feature_names = self.vectorize(documents)
+        with phase("fit"):
+            nmf = NMF(n_components=self.config["N_TOPICS"], random_state=self.config["SEED"]).fit(tfidf)
+        with phase("assign"):
+            # Assign topics to documents
+            topic_distribution = nmf.transform(tfidf)
+            topics = np.argmax(topic_distribution, axis=1)  # Get the index of the highest contribution topic for each document
+            num_topics = len(set(topics))
+
+            # Assign names to topics based on top words
+            top_words_per_topic = top_words(nmf.components_, feature_names)
+
+            # Create a mapping from integer to topic name
+            topic_name_mapping = {i: name for i, name in enumerate(top_words_per_topic)}
+
+            # Create the list of topic names for each document
+            topic_names = [topic_name_mapping[topic] for topic in topics]
+
+        return topics, topic_names, num_topics
+
+    def sweep(self, documents, ks, n_jobs=None):
+        """Fit NMF for every topic count in `ks` on one TF-IDF matrix, to choose the topic count.
+
+        The sorted counts are split into at most `n_jobs` consecutive segments of at
+        least MIN_SEGMENT_SIZE counts, which run on a process pool. The first count of a
+        segment starts from NNDSVD; every further count starts from the factors of the previous one,
+        with components split or merged to the new count, and converges in far fewer
+        iterations. Returns {k: {"topics", "topic_names", "num_topics",
+        "reconstruction_err", "n_iter", "top_words"}}.
+        """
+        ks = sorted(set(ks))
+        n_jobs = n_jobs or self.config.get("NMF_SWEEP_JOBS") or os.cpu_count()
+        with phase("vectorize"):
+            # float32 halves the memory and time of every fit in the sweep
+            tfidf, feature_names = self.vectorize(documents, dtype=np.float32)
+        with phase("fit"):
+            # segments of a single count would start every fit cold
+            n_segments = max(1, min(n_jobs, len(ks) // MIN_SEGMENT_SIZE))
+            segments = [[int(k) for k in segment] for segment in np.array_split(ks, n_segments)]
+            seed = self.config["SEED"]
+            if len(segments) == 1:
+                fits = fit_segment(tfidf, segments[0], seed)
+            else:
+                with ProcessPoolExecutor(len(segments)) as pool:
+                    futures = [pool.submit(fit_segment, tfidf, segment, seed) for segment in segments]
+                    fits = [fit for future in futures for fit in future.result()]
+
+        results = {}
+        with phase("assign"):
+            for k, nmf, W in fits:
+                topics = np.argmax(W, axis=1)
+                names = top_words(nmf.components_, feature_names)
+                results[k] = {
+                    "topics": topics,
+                    "topic_names": [names[topic] for topic in topics],
+                    "num_topics": len(set(topics)),
+                    "reconstruction_err": nmf.reconstruction_err_,
+                    "n_iter": nmf.n_iter_,
+                    "top_words": names,
+                }
+        return results
+
+
+def fit_segment(tfidf, ks, seed):
+    """Fits the counts `ks` one after the other, each warm-started from the previous fit."""
+    fits = []
+    W = H = None
+    for k in ks:
+        if W is None:
+            nmf = NMF(n_components=k, random_state=seed)
+            W = nmf.fit_transform(tfidf)
+        else:
+            W, H = resize_factors(tfidf, W, H, k)
+            nmf = NMF(n_components=k, init="custom", random_state=seed)
+            W = nmf.fit_transform(tfidf, W=W, H=H)
+        H = nmf.components_
+        fits.append((k, nmf, W))
+    return fits
+
+
+def top_words(components, feature_names, n_words=3):
+    """Returns the names of the topics: their `n_words` highest weighted words."""
+    return [" ".join(feature_names[i] for i in topic.argsort()[: -n_words - 1 : -1]) for topic in components]
+
+
+def resize_factors(X, W, H, k):
+    """Returns factors with `k` components derived from the fitted factors W, H.
+
+    To add components, the component with the largest contribution is split in two:
+    the documents assigned to it are factorized with rank-2 NNDSVD, and its weight on
+    all other documents is shared between both halves. To remove components, the two
+    components with the most similar word distributions are merged.
+    """
+    from sklearn.decomposition._nmf import _initialize_nmf
+
+    W, H = W.copy(), H.copy()
+    while W.shape[1] < k:
+        j = np.argmax(np.linalg.norm(W, axis=0) * np.linalg.norm(H, axis=1))
+        members = np.flatnonzero(np.argmax(W, axis=1) == j)
+        W_new = W[:, j] / 2
+        if len(members) >= 2:
+            W_split, H_split = _initialize_nmf(X[members], 2, init="nndsvd")
+            # rescale the halves to the norm of the component they replace
+            scale = np.linalg.norm(H_split, axis=1, keepdims=True) / max(np.linalg.norm(H[j]), 1e-12)
+            scale = np.maximum(scale, 1e-12)
+            H_split, W_split = H_split / scale, W_split * scale.T
+            H[j], H_new = H_split
+            W[:, j] = W_new
+            W[members, j] = W_split[:, 0]
+            W_new = W_new.copy()
+            W_new[members] = W_split[:, 1]
+        else:
+            H_new = H[j].copy()
+            W[:, j] = W_new
+        W = np.column_stack([W, W_new])
+        H = np.vstack([H, H_new])
+    while W.shape[1] > k:
+        normalized = H / np.maximum(np.linalg.norm(H, axis=1, keepdims=True), 1e-12)
+        similarity = normalized @ normalized.T
+        np.fill_diagonal(similarity, -np.inf)
+        a, b = np.unravel_index(np.argmax(similarity), similarity.shape)
+        weights = np.array([W[:, a].sum(), W[:, b].sum()])
+        weights = weights / max(weights.sum(), 1e-12)
+        H[a] = weights[0] * H[a] + weights[1] * H[b]
+        W[:, a] += W[:, b]
+        W, H = np.delete(W, b, axis=1), np.delete(H, b, axis=0)
+    dtype = X.dtype
+    return np.ascontiguousarray(W, dtype=dtype), np.ascontiguousarray(H, dtype=dtype)
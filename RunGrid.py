@@ -0,0 +1,133 @@
+import itertools
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import pandas as pd
+from tqdm import tqdm
+
+from Auxiliary import logger
+from llm_client import client_scope
+from model_registry import load_model_class
+from results_store import ResultsStore
+from TopicModelingInterface import results_path
+
+# models that spend their time on local computation; all other models mostly wait on APIs
+CPU_BOUND_MODELS = {"NMFModel", "LDAGensimModel"}
+GRID_KEYS = ["MODEL_CLASS", "DATASET", "N_documents", "N_TOPICS", "SEED"]
+
+
+def expand_grid(spec, base_config):
+    """This function returns one config per cell of the cartesian product of `spec`.
+
+    `spec` maps config keys (at least MODEL_CLASS) to lists of values; keys that are not
+    in `spec` are taken from `base_config`.
+    """
+    keys = list(spec)
+    # cells that only differ in topic count or seed must not share output files; grids
+    # with one of each keep the untagged file names of the existing results
+    tagged = any(len(spec.get(key, ())) > 1 for key in ("N_TOPICS", "SEED"))
+    cells = []
+    for values in itertools.product(*[spec[key] for key in keys]):
+        config = dict(base_config)
+        config.update(zip(keys, values))
+        if tagged:
+            config["RUN_TAG"] = f"k{config['N_TOPICS']}_s{config['SEED']}"
+        cells.append(config)
+    return cells
+
+
+def cell_name(config):
+    return "_".join(str(config[key]) for key in GRID_KEYS)
+
+
+def cell_is_complete(config):
+    store = ResultsStore(config.get("RESULTS_STORE", "data_out/results.sqlite"))
+    stored_runs = store.count_runs(
+        model=config["MODEL_CLASS"],
+        dataset=config["DATASET"],
+        n_documents=config["N_documents"],
+        n_topics=config["N_TOPICS"],
+        seed=config["SEED"],
+        run_tag=config.get("RUN_TAG") or "",
+    )
+    if stored_runs >= config["N_runs"]:
+        return True
+    # cells finished before the results store existed only have their CSVs
+    path = results_path("coherence_scores", config["MODEL_CLASS"], config)
+    if not os.path.exists(path):
+        return False
+    scores = pd.read_csv(path)
+    if "run" in scores.columns:
+        return scores["run"].nunique() >= config["N_runs"]
+    # older files have no run column but one row per metric and finished run
+    return len(scores) >= scores["metric_name"].nunique() * config["N_runs"]
+
+
+def run_cell(config):
+    start = time.time()
+    model = load_model_class(config["MODEL_CLASS"])(config)
+    model.run()
+    return time.time() - start
+
+
+def run_grid(spec, base_config, max_processes=None, max_llm_cells=4):
+    """This function runs every cell of the grid that has no results yet.
+
+    CPU-bound cells run on a process pool with one worker per core. The other cells run
+    on a thread pool of `max_llm_cells` threads, so their requests share the global
+    request scheduler of genai_functions and therefore one rate budget.
+    """
+    cells = expand_grid(spec, base_config)
+    pending = [config for config in cells if not cell_is_complete(config)]
+    logger.info(
+        f"Grid has {len(cells)} cells, {len(cells) - len(pending)} already complete"
+    )
+    cpu_cells = [c for c in pending if c["MODEL_CLASS"] in CPU_BOUND_MODELS]
+    llm_cells = [c for c in pending if c["MODEL_CLASS"] not in CPU_BOUND_MODELS]
+
+    failed = []
+    # LLM cells run on threads of this process and share one pooled client;
+    # spawn keeps the worker processes independent of these threads
+    with client_scope(base_config), ProcessPoolExecutor(
+        max_workers=max_processes or os.cpu_count(),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as process_pool, ThreadPoolExecutor(max_workers=max_llm_cells) as thread_pool:
+        futures = {process_pool.submit(run_cell, c): c for c in cpu_cells}
+        futures.update({thread_pool.submit(run_cell, c): c for c in llm_cells})
+        with tqdm(total=len(cells), initial=len(cells) - len(pending), desc="grid") as progress:
+            for future in as_completed(futures):
+                config = futures[future]
+                try:
+                    elapsed = future.result()
+                    logger.info(f"Finished {cell_name(config)} in {elapsed:.0f} seconds")
+                except Exception as e:
+                    logger.error(f"Cell {cell_name(config)} failed: {e!r}")
+                    failed.append(config)
+                progress.update(1)
+    return failed
+
+
+if __name__ == "__main__":
+    base_config = {
+        "SEED": 44,
+        "N_runs": 5,
+        "N_documents": 800,
+        "N_TOPICS": 50,
+        "TOKEN_LIMIT": 6_000,
+        "DATASET": "NYT",
+        "MODEL": "gpt-4o",
+        "N_FEATURES": 1000,
+        "MAX_CONCURRENCY": 50,
+        "RPM_LIMIT": 5_000,
+        "TPM_LIMIT": 800_000,
+    }
+    spec = {
+        "MODEL_CLASS": ["NMFModel", "LDAGensimModel", "GenAIMethodOneShot"],
+        "DATASET": ["NYT", "ARXIV", "PUBMED", "NEWSGROUPS"],
+        "N_documents": [400, 800],
+        "N_TOPICS": [50],
+        "SEED": [44],
+    }
+    run_grid(spec, base_config)
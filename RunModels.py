@@ -1,23 +1,113 @@
-from BERTopicModel import BERTopicModel
-from GenAIMethodOneShot import GenAIMethodOneShot
-from GenAIMethod import GenAIMethod
-from GenAIMethodOneShotNoPrior import GenAIMethodOneShotNoPrior
+import argparse
+import json
 
+from model_registry import MODELS, load_model_class
 
-def run_models(config):
-    models = [GenAIMethodOneShotNoPrior(config)]
-    for model in models:
+DEFAULT_MODELS = ["GenAIMethodOneShotNoPrior"]
+DEFAULT_CONFIG = {
+    "SEED": 44,
+    "N_runs": 5,
+    "N_documents": 800,
+    "N_TOPICS": 50,
+    "TOKEN_LIMIT": 6_000,
+    "DATASET": "NYT",
+    "MODEL": "gpt-4o",
+    "N_FEATURES": 1000,
+    # pack documents for topic creation first-fit-decreasing, or in their original order
+    "CHUNK_KEEP_ORDER": False,
+    # "single" sends one classification request per document, "batched" packs several,
+    # "logprobs" asks for a single index token and keeps the topic probabilities,
+    # "embedding" assigns by similarity to the topic names without chat completions
+    "CLASSIFICATION_MODE": "single",
+    "CLASSIFICATION_BATCH_SIZE": 20,
+    "CLASSIFICATION_BATCH_TOKENS": 8_000,
+    # attempts to reclassify documents whose answer was unusable, at rising temperatures
+    "REPAIR_ATTEMPTS": 3,
+    "EMBEDDING_PROVIDER": "hashing",
+    # GenAIMethod only: "pairwise" or "rounds" of several disjoint merges per request
+    "ELIMINATION_MODE": "pairwise",
+    # throughput shared by all parallel LLM requests
+    "MAX_CONCURRENCY": 50,
+    "RPM_LIMIT": 5_000,
+    "TPM_LIMIT": 800_000,
+    "HTTP_POOL_LIMIT": 100,
+    # unclassified documents are "exclude"d from scoring, or scored as "singleton"s or one "cluster"
+    "EVAL_ERROR_POLICY": "exclude",
+    "EVAL_BOOTSTRAP": 1_000,
+    # "online", or "batch" to send phases of at least BATCH_MIN_REQUESTS prompts as one bulk job
+    "LLM_BACKEND": "online",
+    "BATCH_MIN_REQUESTS": 100,
+    # every run is stored in one SQLite file; the legacy CSVs are exported after the last run
+    "RESULTS_STORE": "data_out/results.sqlite",
+    "RESULTS_CSV_EXPORT": True,
+    # outputs of finished phases, so an interrupted GenAI run resumes where it stopped
+    "CHECKPOINT_DIR": "cache/checkpoints",
+    "CHECKPOINT_BATCH_SIZE": 500,
+}
+
+
+def run_models(config, model_names=DEFAULT_MODELS):
+    for name in model_names:
+        # the backend of a model is imported only here, once it has been selected
+        model = load_model_class(name)(config)
         model.run()
 
+
+def parse_value(value):
+    """Values of --set are JSON (numbers, booleans, null, lists), anything else is a string."""
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return value
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run topic models over a dataset and store their scores in data_out."
+    )
+    parser.add_argument(
+        "models",
+        nargs="*",
+        metavar="MODEL",
+        help=f"models to run, from {', '.join(MODELS)} (default: {' '.join(DEFAULT_MODELS)})",
+    )
+    parser.add_argument(
+        "--config", help="JSON file with config keys that replace the defaults in RunModels.py"
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="set one config key, e.g. --set N_runs=1 --set DATASET=PUBMED; applied after --config",
+    )
+    parser.add_argument(
+        "--show-config", action="store_true", help="print the resulting config and exit"
+    )
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.models if name not in MODELS]
+    if unknown:
+        parser.error(f"unknown models {unknown}, choose from {list(MODELS)}")
+
+    config = dict(DEFAULT_CONFIG)
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            config.update(json.load(f))
+    for assignment in args.set:
+        key, separator, value = assignment.partition("=")
+        if not separator:
+            parser.error(f"--set expects KEY=VALUE, got {assignment}")
+        config[key] = parse_value(value)
+    return args, config
+
+
+def main(argv=None):
+    args, config = parse_args(argv)
+    if args.show_config:
+        print(json.dumps(config, indent=4))
+        return
+    run_models(config, args.models or DEFAULT_MODELS)
+
+
 if __name__ == "__main__":
-    config = {
-        "SEED": 44,
-        "N_runs": 5,
-        "N_documents": 800,
-        "N_TOPICS": 50,
-        "TOKEN_LIMIT": 6_000,
-        "DATASET": "NYT",
-        "MODEL": "gpt-4o",
-        "N_FEATURES": 1000,
-    }
-    run_models(config)
+    main()
@@ -1,12 +1,22 @@
 import random
+import time
 import numpy as np
-import pandas as pd
 from tqdm import tqdm
-from sklearn.datasets import fetch_20newsgroups
-from sklearn.metrics.cluster import v_measure_score, homogeneity_score, completeness_score, adjusted_mutual_info_score
-import tiktoken
 from collections import defaultdict
-from Datasets import get_nyt, get_arxiv, get_pubmed
+from Datasets import load_dataset
+from token_index import TokenIndex
+from evaluation import score_rows
+from phases import phase
+from ledger import RunLedger, use_ledger
+from llm_client import client_scope
+from results_store import ResultsStore
+from Auxiliary import logger
+
+
+def results_path(kind, class_name, config):
+    """This function returns the output CSV of a model/size/dataset, e.g. kind="coherence_scores"."""
+    tag = f"_{config['RUN_TAG']}" if config.get("RUN_TAG") else ""
+    return f"data_out/{kind}_{class_name}_{config['N_documents']}_{config['DATASET']}{tag}.csv"
 
 
 class TopicModelingInterface:
@@ -19,6 +29,7 @@ class TopicModelingInterface:
         self.token_limit = config["TOKEN_LIMIT"]
         self.dataset = config["DATASET"]
         self.random_state = config["SEED"]
+        self.store = ResultsStore(config.get("RESULTS_STORE", "data_out/results.sqlite"))
 
     def preprocess_documents(self, documents):
         raise NotImplementedError
@@ -30,57 +41,82 @@ class TopicModelingInterface:
         raise NotImplementedError
 
     def run(self):
+        # one pooled HTTP client serves the LLM calls of every run and phase
+        with client_scope(self.config):
+            self._run()
+
+    def _run(self):
         random.seed(self.seed)
-        score_df = []
-        topic_name_df = []
+        # documents are sampled from a private generator so that models running in
+        # other threads (and their random.shuffle calls) cannot change the sample
+        sampler = random.Random(self.seed)
+        # the dataset is loaded once per process and shared by all runs
+        dataset = load_dataset(self.dataset)
+        # token counts of gpt-3.5-turbo's encoding, computed once per dataset version
+        token_index = TokenIndex.load_or_build(
+            self.dataset,
+            dataset.data,
+            dataset.target,
+            source_path=dataset.path,
+        )
+        filtered_data_indices = np.flatnonzero(token_index.mask(self.token_limit))
+        filtered_labels = token_index.labels[filtered_data_indices]
         for counter in tqdm(range(self.n_runs)):
-            enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
-
-            if self.dataset == "NYT":
-                newsgroups_train = get_nyt()
-            elif self.dataset == "ARXIV":
-                newsgroups_train = get_arxiv()
-            elif self.dataset == "PUBMED":
-                newsgroups_train = get_pubmed()   
-            else:
-                newsgroups_train = fetch_20newsgroups(
-                    subset="train", remove=("headers", "footers", "quotes")
-                )
-
-            filtered_data_indices = [
-                i
-                for i, document in enumerate(newsgroups_train.data)
-                if len(document) > 0 and len(enc.encode(document)) < self.token_limit
-            ]
-            filtered_data = [newsgroups_train.data[i] for i in filtered_data_indices]
-            filtered_labels = [
-                newsgroups_train.target[i] for i in filtered_data_indices
-            ]
             # filter randomly self.n_documents indices
-            indices = random.sample(
-                range(len(filtered_data)), min(self.n_documents, len(filtered_data))
-            )
-            documents = [filtered_data[i] for i in indices]
-            labels = [filtered_labels[i] for i in indices]
-            
-            ground_truth_names = [newsgroups_train.target_names[label] for label in labels]
-            topics, topic_names, num_topics = self.fit_transform(documents)
-            score = v_measure_score(labels, topics)
-            score_df.append(("V_measure", score, num_topics))
-            score_df.append(("completeness", completeness_score(labels, topics), num_topics))
-            score_df.append(("homogeneity", homogeneity_score(labels, topics), num_topics))
-            score_df.append(("adjusted_mutual_info", adjusted_mutual_info_score(labels, topics), num_topics))
-            topic_name_df.append(pd.DataFrame({"topic_name": topic_names, "ground_truth": ground_truth_names, "run": counter}))
-
-            score_df_out = pd.DataFrame(
-                score_df, columns=["metric_name", "score", "num_topics"]
+            indices = sampler.sample(
+                range(len(filtered_data_indices)),
+                min(self.n_documents, len(filtered_data_indices)),
             )
-            score_df_out.to_csv(
-                f"data_out/coherence_scores_{self.__class__.__name__}_{self.n_documents}_{self.dataset}.csv"
+            documents = [dataset.data[filtered_data_indices[i]] for i in indices]
+            labels = [int(filtered_labels[i]) for i in indices]
+
+            ground_truth_names = [dataset.target_names[label] for label in labels]
+            ledger = RunLedger()
+            start = time.perf_counter()
+            with use_ledger(ledger):
+                topics, topic_names, num_topics = self.fit_transform(documents)
+            seconds = time.perf_counter() - start
+            totals = ledger.totals()
+            with phase("scoring"):
+                scores = self.score(labels, topics, num_topics)
+            # the topic indices, including error codes, allow re-scoring with evaluation.rescore
+            self.store.add_run(
+                self.__class__.__name__,
+                self.config,
+                counter,
+                scores,
+                topics,
+                topic_names,
+                ground_truth_names,
+                ledger_rows=ledger.rows(),
+                totals=totals,
+                seconds=seconds,
             )
-            pd.concat(topic_name_df).to_csv(
-                f"data_out/topic_names_{self.__class__.__name__}_{self.n_documents}_{self.dataset}.csv"
+
+        if self.config.get("RESULTS_CSV_EXPORT", True):
+            # the legacy CSVs are written once, after the last run; the filters are the
+            # config values add_run stored, since fit_transform may change self.n_topics
+            paths = self.store.export_csv(
+                model=self.__class__.__name__,
+                dataset=self.config["DATASET"],
+                n_documents=self.config["N_documents"],
+                n_topics=self.config.get("N_TOPICS"),
+                seed=self.config.get("SEED"),
+                run_tag=self.config.get("RUN_TAG") or "",
             )
+            if not paths:
+                logger.warning(f"No stored runs of {self.__class__.__name__} matched the CSV export")
+
+    def score(self, labels, topics, num_topics):
+        """Returns (metric_name, score, num_topics, ci_low, ci_high) rows comparing topics with the ground truth."""
+        return score_rows(
+            labels,
+            topics,
+            num_topics,
+            error_policy=self.config.get("EVAL_ERROR_POLICY", "exclude"),
+            n_bootstrap=self.config.get("EVAL_BOOTSTRAP", 1_000),
+            seed=self.seed,
+        )
 
     def sample_equal_per_class(self, data, labels, n_documents, random_state=None):
         if random_state is not None:
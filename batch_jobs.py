@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+from Auxiliary import logger
+
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class OpenAIBatchBackend:
+    """Submits JSONL request files to the /files and /batches endpoints of an OpenAI-compatible API."""
+
+    def __init__(self, api_base, api_key, completion_window="24h", timeout=300):
+        self.api_base = api_base.rstrip("/")
+        self.headers = {"Authorization": f"Bearer {api_key}"}
+        self.completion_window = completion_window
+        self.timeout = timeout
+
+    def _request(self, method, path, **kwargs):
+        import requests
+
+        response = requests.request(
+            method, f"{self.api_base}{path}", headers=self.headers, timeout=self.timeout, **kwargs
+        )
+        response.raise_for_status()
+        return response
+
+    def submit(self, path):
+        with open(path, "rb") as f:
+            upload = self._request(
+                "POST", "/files", data={"purpose": "batch"}, files={"file": f}
+            ).json()
+        batch = self._request(
+            "POST",
+            "/batches",
+            json={
+                "input_file_id": upload["id"],
+                "endpoint": "/v1/chat/completions",
+                "completion_window": self.completion_window,
+            },
+        ).json()
+        return batch["id"]
+
+    def status(self, job_id):
+        """Returns the job status and, once the job has ended, the ids of its output files."""
+        batch = self._request("GET", f"/batches/{job_id}").json()
+        return batch["status"], [batch.get("output_file_id"), batch.get("error_file_id")]
+
+    def download(self, job_id, outputs, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for file_id in outputs:
+                if file_id:
+                    f.write(self._request("GET", f"/files/{file_id}/content").text)
+
+
+class DirectoryBatchBackend:
+    """Local stand-in for a batch endpoint: jobs are files in `directory`/pending and
+    results are picked up from `directory`/done, where a watcher process writes them.
+
+    The output lines use the format of the OpenAI batch endpoint, see
+    benchmarks/fake_openai.py for a watcher that answers them.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(os.path.join(directory, "pending"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "done"), exist_ok=True)
+
+    def submit(self, path):
+        job_id = f"batch_{uuid.uuid4().hex}"
+        target = os.path.join(self.directory, "pending", f"{job_id}.jsonl")
+        with open(path, "rb") as source, open(target + ".tmp", "wb") as f:
+            f.write(source.read())
+        # the rename makes the job visible to the watcher only once it is complete
+        os.replace(target + ".tmp", target)
+        return job_id
+
+    def status(self, job_id):
+        done = os.path.join(self.directory, "done", f"{job_id}.jsonl")
+        if os.path.exists(done):
+            return "completed", [done]
+        if os.path.exists(os.path.join(self.directory, "pending", f"{job_id}.jsonl")):
+            return "in_progress", []
+        return "failed", []
+
+    def download(self, job_id, outputs, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for output in outputs:
+                with open(output, encoding="utf-8") as source:
+                    f.write(source.read())
+
+
+class BatchJobRunner:
+    """Runs lists of chat-completion requests as bulk jobs and maps the answers back to their order.
+
+    Submitted jobs are recorded in a JSON manifest keyed by the hash of their requests,
+    so a process that restarts with the same requests resumes polling the same job
+    instead of submitting it again. Downloaded outputs are kept next to the manifest.
+    """
+
+    def __init__(self, backend, directory="cache/batches", poll_interval=30, max_wait=None):
+        self.backend = backend
+        self.directory = directory
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.manifest_path = os.path.join(directory, "jobs.json")
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _update_manifest(self, key, job):
+        with self._lock:
+            manifest = self._load_manifest()
+            if job is None:
+                manifest.pop(key, None)
+            else:
+                manifest[key] = job
+            with open(self.manifest_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=1)
+            os.replace(self.manifest_path + ".tmp", self.manifest_path)
+
+    def run(self, bodies, endpoint="/v1/chat/completions"):
+        """Run one request per body and return the response bodies in input order, with None for failures."""
+        lines = [
+            json.dumps(
+                {"custom_id": f"request-{i}", "method": "POST", "url": endpoint, "body": body},
+                sort_keys=True,
+            )
+            for i, body in enumerate(bodies)
+        ]
+        key = hashlib.sha256("\n".join(lines).encode("utf-8")).hexdigest()[:32]
+        output_path = os.path.join(self.directory, f"{key}.output.jsonl")
+
+        with self._lock:
+            job = self._load_manifest().get(key)
+        if job is None:
+            input_path = os.path.join(self.directory, f"{key}.input.jsonl")
+            with open(input_path, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            job = {"job_id": self.backend.submit(input_path), "status": "submitted", "n_requests": len(lines)}
+            job["submitted_at"] = time.time()
+            self._update_manifest(key, job)
+            logger.info(f"Submitted batch job {job['job_id']} with {len(lines)} requests")
+        else:
+            logger.info(f"Resuming batch job {job['job_id']} ({job['status']})")
+
+        if job["status"] != "completed" or not os.path.exists(output_path):
+            status = self._wait(job["job_id"])
+            if status is None:
+                raise TimeoutError(f"Batch job {job['job_id']} did not finish in {self.max_wait} seconds")
+            status, outputs = status
+            if status != "completed":
+                # failed jobs are forgotten so that the next attempt submits them again
+                self._update_manifest(key, None)
+                logger.error(f"Batch job {job['job_id']} ended with status {status}")
+                if status != "expired":
+                    return [None] * len(bodies)
+            self.backend.download(job["job_id"], outputs, output_path)
+            if status == "completed":
+                job["status"] = "completed"
+                self._update_manifest(key, job)
+
+        results = [None] * len(bodies)
+        with open(output_path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                response = entry.get("response") or {}
+                index = int(entry["custom_id"].rsplit("-", 1)[1])
+                if response.get("status_code") == 200 and 0 <= index < len(results):
+                    results[index] = response["body"]
+        logger.info(
+            f"Batch job {job['job_id']}: {sum(r is not None for r in results)} of {len(results)} requests succeeded"
+        )
+        return results
+
+    def _wait(self, job_id):
+        start = time.monotonic()
+        while self.max_wait is None or time.monotonic() - start < self.max_wait:
+            status, outputs = self.backend.status(job_id)
+            if status in TERMINAL_STATUSES:
+                return status, outputs
+            time.sleep(self.poll_interval)
+        return None
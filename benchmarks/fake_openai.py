@@ -0,0 +1,364 @@
+"""In-process stand-in for the OpenAI chat-completions and embeddings endpoints.
+
+The server answers the prompts of genai_functions with deterministic JSON derived
+from a hash of the prompt content. It can add latency and inject errors and 429s,
+so the pipeline can be benchmarked without an API key and without spending money.
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+
+from aiohttp import web
+
+
+def stable_hash(text):
+    return int(hashlib.md5(text.encode("utf-8")).hexdigest()[:12], 16)
+
+
+def answer_prompt(prompt, topic_pool_size=60):
+    """This function returns the JSON answer the fake model gives to one of the pipeline's prompts."""
+    n_listed_topics = len(re.findall(r"^#\d+:", prompt, flags=re.MULTILINE))
+
+    if "distill a list of topics from the following" in prompt:
+        documents = [d for d in prompt.split("DOCUMENT:")[1:] if d.strip()]
+        return {"topics": [f"topic {stable_hash(d) % topic_pool_size}" for d in documents]}
+
+    if "distill a list of core topics" in prompt:
+        topics = sorted(set(re.findall(r"topic \d+", prompt)))
+        match = re.search(r"about (\d+) topics", prompt)
+        n_topics = int(match.group(1)) if match else max(1, len(topics) // 2)
+        return {"topics": topics[:n_topics]}
+
+    if "classify each of the following documents" in prompt:
+        documents = re.findall(r"DOCUMENT (\d+): (.*?)(?=\n\nDOCUMENT \d+: |\Z)", prompt, flags=re.DOTALL)
+        return {
+            "classifications": [
+                {"doc_id": int(doc_id), "topic": stable_hash(text) % max(n_listed_topics, 1)}
+                for doc_id, text in documents
+            ]
+        }
+
+    if "classify the following document" in prompt:
+        match = re.search(r"DOCUMENT: (.*)\Z", prompt, flags=re.DOTALL)
+        document = match.group(1) if match else prompt
+        return {"topic": stable_hash(document) % max(n_listed_topics, 1)}
+
+    match = re.search(r"merge up to (\d+) pairs", prompt)
+    if match:
+        n_merges = min(int(match.group(1)), n_listed_topics // 2)
+        return {
+            "merges": [
+                {"topic_pair": [2 * i, 2 * i + 1], "new_topic": f"merged {stable_hash(prompt) % 10_000}_{i}"}
+                for i in range(n_merges)
+            ]
+        }
+
+    if "merge a pair of topics" in prompt:
+        return {"topic_pair": [0, 1], "new_topic": f"merged {stable_hash(prompt) % 10_000}"}
+
+    return {}
+
+
+class FakeOpenAIServer:
+    """Runs the fake endpoints on a background thread; use as a context manager.
+
+    Latency is drawn per request from `latency` ("constant", "uniform" or
+    "lognormal") around `latency_median` seconds. A fraction `error_rate` of
+    requests fails with HTTP 500 and a fraction `rate_limit_rate` with HTTP 429
+    and a Retry-After header of `retry_after` seconds. With `prefix_cache` the
+    server reports the prompt prefix it has seen before as cached tokens, in blocks
+    of `prefix_block_tokens` once the prefix has `min_cached_prefix_tokens`. The
+    defaults follow OpenAI; engines such as vLLM cache much smaller blocks.
+    """
+
+    def __init__(
+        self,
+        latency="lognormal",
+        latency_median=0.2,
+        latency_sigma=0.5,
+        error_rate=0.0,
+        rate_limit_rate=0.0,
+        retry_after=0.1,
+        embedding_dim=64,
+        prefix_cache=True,
+        prefix_block_tokens=128,
+        min_cached_prefix_tokens=1024,
+        seed=0,
+    ):
+        self.latency = latency
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.embedding_dim = embedding_dim
+        self.prefix_cache = prefix_cache
+        # the fake tokenizer counts 4 characters per token
+        self.prefix_block_chars = 4 * prefix_block_tokens
+        self.min_cached_prefix_chars = 4 * min_cached_prefix_tokens
+        self._seen_prefixes = set()
+        self.random = random.Random(seed)
+        self.base_url = None
+        self._loop = None
+        self._thread = None
+        self._runner = None
+        self._watchers = []
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {
+                "requests": 0,
+                "chat_completions": 0,
+                "embeddings": 0,
+                "batch_jobs": 0,
+                "errors": 0,
+                "rate_limited": 0,
+                "prompt_tokens": 0,
+                "cached_tokens": 0,
+                "completion_tokens": 0,
+            }
+
+    def _count(self, **increments):
+        with self._lock:
+            for key, value in increments.items():
+                self.stats[key] += value
+
+    def _sample_latency(self):
+        if self.latency == "constant":
+            return self.latency_median
+        if self.latency == "uniform":
+            return self.random.uniform(0, 2 * self.latency_median)
+        return self.random.lognormvariate(math.log(self.latency_median), self.latency_sigma)
+
+    def _cached_prefix_chars(self, prompt):
+        """Return the length of the longest block-aligned prefix of `prompt` seen before, and remember its prefixes."""
+        if not self.prefix_cache:
+            return 0
+        first, block = self.min_cached_prefix_chars, self.prefix_block_chars
+        digest = hashlib.md5(prompt[:first].encode("utf-8"))
+        cached = 0
+        with self._lock:
+            for end in range(first, len(prompt) + 1, block):
+                if end > first:
+                    digest.update(prompt[end - block : end].encode("utf-8"))
+                key = digest.digest()
+                if key in self._seen_prefixes:
+                    cached = end
+                else:
+                    self._seen_prefixes.add(key)
+        return cached
+
+    async def _inject(self):
+        """Sleep for the sampled latency and return an error response if one is injected."""
+        self._count(requests=1)
+        await asyncio.sleep(self._sample_latency())
+        draw = self.random.random()
+        if draw < self.rate_limit_rate:
+            self._count(rate_limited=1)
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "rate_limit"}},
+                status=429,
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        if draw < self.rate_limit_rate + self.error_rate:
+            self._count(errors=1)
+            return web.json_response(
+                {"error": {"message": "Injected server error", "type": "server_error"}},
+                status=500,
+            )
+        return None
+
+    async def chat_completions(self, request):
+        body = await request.json()
+        error = await self._inject()
+        if error is not None:
+            return error
+        return web.json_response(self.completion(body))
+
+    def completion(self, body):
+        """Return the chat completion response for a request body."""
+        prompt = "\n".join(message["content"] for message in body["messages"])
+        answer = answer_prompt(prompt)
+        if body.get("response_format") is None and "topic" in answer:
+            # plain-text classification: the bare index, one token
+            content = str(answer["topic"])
+        else:
+            content = json.dumps(answer)
+        prompt_tokens = len(prompt) // 4
+        cached_tokens = self._cached_prefix_chars(prompt) // 4
+        completion_tokens = max(1, len(content) // 4)
+        self._count(
+            chat_completions=1,
+            prompt_tokens=prompt_tokens,
+            cached_tokens=cached_tokens,
+            completion_tokens=completion_tokens,
+        )
+        choice = {
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+            "logprobs": None,
+        }
+        if body.get("logprobs"):
+            choice["logprobs"] = {
+                "content": [
+                    {
+                        "token": content,
+                        "logprob": 0.0,
+                        "bytes": None,
+                        "top_logprobs": self._top_logprobs(prompt, content, body.get("top_logprobs", 0)),
+                    }
+                ]
+            }
+        return {
+            "id": f"chatcmpl-{stable_hash(prompt)}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [choice],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            },
+        }
+
+    def answer_batch_file(self, path):
+        """Answer every request line of a batch input file, in the output format of the batch endpoint."""
+        lines = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                request = json.loads(line)
+                if self.random.random() < self.error_rate:
+                    self._count(errors=1)
+                    response = {"status_code": 500, "body": {"error": {"message": "Injected server error"}}}
+                else:
+                    response = {"status_code": 200, "body": self.completion(request["body"])}
+                response["request_id"] = f"req_{stable_hash(line)}"
+                lines.append(
+                    json.dumps(
+                        {
+                            "id": f"batch_req_{stable_hash(line)}",
+                            "custom_id": request["custom_id"],
+                            "response": response,
+                            "error": None,
+                        }
+                    )
+                )
+        return "\n".join(lines) + "\n"
+
+    def watch_batch_directory(self, directory, poll_interval=0.05):
+        """Answer the jobs a DirectoryBatchBackend puts in `directory`/pending until the server stops."""
+        pending = os.path.join(directory, "pending")
+        done = os.path.join(directory, "done")
+        os.makedirs(pending, exist_ok=True)
+        os.makedirs(done, exist_ok=True)
+
+        async def watch():
+            while True:
+                for name in sorted(os.listdir(pending)):
+                    if not name.endswith(".jsonl"):
+                        continue
+                    self._count(batch_jobs=1)
+                    output = self.answer_batch_file(os.path.join(pending, name))
+                    with open(os.path.join(done, name + ".tmp"), "w", encoding="utf-8") as f:
+                        f.write(output)
+                    os.replace(os.path.join(done, name + ".tmp"), os.path.join(done, name))
+                    os.remove(os.path.join(pending, name))
+                await asyncio.sleep(poll_interval)
+
+        def schedule():
+            self._watchers.append(self._loop.create_task(watch()))
+
+        self._loop.call_soon_threadsafe(schedule)
+
+    def _top_logprobs(self, prompt, content, n):
+        """Spread the probability of an index answer over it and the next indices; other answers get 1."""
+        n_listed_topics = len(re.findall(r"^#\d+:", prompt, flags=re.MULTILINE))
+        if not content.isdigit() or n_listed_topics == 0:
+            return [{"token": content, "logprob": 0.0, "bytes": None}][:n]
+        confidence = 0.4 + 0.5 * (stable_hash(prompt) % 100) / 100
+        alternatives = [(int(content) + k) % n_listed_topics for k in (1, 2)]
+        candidates = [(int(content), confidence)] + [(a, (1 - confidence) / 2) for a in alternatives]
+        return [
+            {"token": str(index), "logprob": math.log(probability), "bytes": None}
+            for index, probability in candidates[:n]
+        ]
+
+    async def embeddings(self, request):
+        body = await request.json()
+        error = await self._inject()
+        if error is not None:
+            return error
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        self._count(embeddings=1, prompt_tokens=sum(len(text) // 4 for text in inputs))
+        data = []
+        for index, text in enumerate(inputs):
+            generator = random.Random(stable_hash(text))
+            data.append(
+                {
+                    "object": "embedding",
+                    "index": index,
+                    "embedding": [generator.gauss(0, 1) for _ in range(self.embedding_dim)],
+                }
+            )
+        return web.json_response(
+            {
+                "object": "list",
+                "data": data,
+                "model": body.get("model", "fake"),
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            }
+        )
+
+    def start(self):
+        started = threading.Event()
+
+        def serve():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            app = web.Application(client_max_size=64 * 1024**2)
+            app.router.add_post("/v1/chat/completions", self.chat_completions)
+            app.router.add_post("/v1/embeddings", self.embeddings)
+            self._runner = web.AppRunner(app, access_log=None)
+            self._loop.run_until_complete(self._runner.setup())
+            site = web.TCPSite(self._runner, "127.0.0.1", 0)
+            self._loop.run_until_complete(site.start())
+            port = site._server.sockets[0].getsockname()[1]
+            self.base_url = f"http://127.0.0.1:{port}/v1"
+            started.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=serve, daemon=True)
+        self._thread.start()
+        started.wait()
+        return self.base_url
+
+    def stop(self):
+        if self._loop is None:
+            return
+        for watcher in self._watchers:
+            self._loop.call_soon_threadsafe(watcher.cancel)
+        self._watchers = []
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,184 @@
+"""End-to-end benchmark of every topic model against the fake OpenAI server.
+
+Usage: python benchmarks/run_benchmarks.py --sizes 100 400 800 --latency-median 0.2
+
+For every model and corpus size the benchmark times each pipeline phase, counts the
+requests the fake server received, and measures peak Python memory. Results are
+written as JSON to benchmarks/results/ so runs can be diffed against each other.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import traceback
+import tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from fake_openai import FakeOpenAIServer
+
+DEFAULT_MODELS = [
+    "NMFModel",
+    "LDAGensimModel",
+    "GenAIMethodOneShot",
+    "GenAIMethodOneShotNoPrior",
+    "GenAIMethod",
+    "BERTopicModel",
+]
+
+
+def letters(number):
+    """Writes a non-negative integer in base 26 with the letters a-z, e.g. 27 -> "bb"."""
+    digits = ""
+    while True:
+        number, digit = divmod(number, 26)
+        digits = "abcdefghijklmnopqrstuvwxyz"[digit] + digits
+        if number == 0:
+            return digits
+
+
+def synthetic_corpus(n_documents, n_classes=10, seed=0):
+    """This function returns documents drawn from class-specific vocabularies, plus their labels.
+
+    Words contain only letters, since the LDA preprocessing drops digits.
+    """
+    generator = random.Random(seed)
+    common_words = [f"common{letters(j)}" for j in range(200)]
+    documents, labels = [], []
+    for _ in range(n_documents):
+        label = generator.randrange(n_classes)
+        class_words = [f"class{letters(label)}word{letters(j)}" for j in range(30)]
+        n_words = generator.randint(40, 200)
+        words = [
+            generator.choice(class_words) if generator.random() < 0.6 else generator.choice(common_words)
+            for _ in range(n_words)
+        ]
+        documents.append(" ".join(words))
+        labels.append(label)
+    return documents, labels
+
+
+def benchmark_model(class_name, config, documents, labels, server, measure_memory=True):
+    from ledger import RunLedger, use_ledger
+    from phases import phase, recorder
+    from RunGrid import load_model_class
+
+    recorder.reset()
+    server.reset_stats()
+    if measure_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    model = load_model_class(class_name)(config)
+    ledger = RunLedger()
+    with phase("fit_transform"), use_ledger(ledger):
+        topics, topic_names, num_topics = model.fit_transform(list(documents))
+    with phase("scoring"):
+        scores = model.score(labels, topics, num_topics)
+    wall_seconds = time.perf_counter() - start
+    peak_memory = tracemalloc.get_traced_memory()[1] if measure_memory else None
+    if measure_memory:
+        tracemalloc.stop()
+    return {
+        "wall_seconds": wall_seconds,
+        "peak_memory_mb": peak_memory / 1024**2 if peak_memory is not None else None,
+        "num_topics": int(num_topics),
+        "scores": {name: float(score) for name, score, *_ in scores},
+        "confidence_intervals": {name: [low, high] for name, _, _, low, high in scores},
+        "requests": dict(server.stats),
+        "phases": recorder.snapshot(),
+        "ledger": ledger.rows(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--models", nargs="+", default=DEFAULT_MODELS)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[100, 400, 800])
+    parser.add_argument("--n-topics", type=int, default=20)
+    parser.add_argument("--latency", choices=["constant", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--latency-median", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--max-concurrency", type=int, default=50)
+    parser.add_argument(
+        "--min-cached-prefix", type=int, default=1024,
+        help="shortest prompt prefix, in tokens, the fake server reports as cached",
+    )
+    parser.add_argument("--prefix-in-system", action="store_true", help="send static prompt prefixes as the system message")
+    parser.add_argument("--no-memory", action="store_true", help="skip tracemalloc, which slows the run down")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    server = FakeOpenAIServer(
+        latency=args.latency,
+        latency_median=args.latency_median,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        min_cached_prefix_tokens=args.min_cached_prefix,
+        prefix_block_tokens=min(128, args.min_cached_prefix),
+    )
+    with server:
+        # must be set before genai_functions is imported by the first model
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        os.environ["OPENAI_KEY"] = "fake-key"
+        os.environ["LLM_CACHE"] = "0"
+        os.environ["LLM_PREFIX_IN_SYSTEM"] = "1" if args.prefix_in_system else "0"
+
+        results = []
+        embedding_dir = tempfile.TemporaryDirectory(prefix="benchmark_embeddings_")
+        for n_documents in args.sizes:
+            documents, labels = synthetic_corpus(n_documents)
+            config = {
+                "SEED": 44,
+                "N_runs": 1,
+                "N_documents": n_documents,
+                "N_TOPICS": args.n_topics,
+                "TOKEN_LIMIT": 6_000,
+                "DATASET": "SYNTHETIC",
+                "MODEL": "gpt-4o",
+                "N_FEATURES": 1000,
+                "MAX_CONCURRENCY": args.max_concurrency,
+                # resuming phases or reusing stored tokens or embeddings would skip the work being measured
+                "CHECKPOINT_DIR": None,
+                "LDA_TOKEN_STORE": None,
+                "EMBEDDING_STORE_DIR": os.path.join(embedding_dir.name, str(n_documents)),
+            }
+            for class_name in args.models:
+                print(f"Benchmarking {class_name} on {n_documents} documents")
+                entry = {"model": class_name, "n_documents": n_documents}
+                try:
+                    entry.update(
+                        benchmark_model(
+                            class_name, config, documents, labels, server, not args.no_memory
+                        )
+                    )
+                except Exception as e:
+                    traceback.print_exc()
+                    entry["error"] = repr(e)
+                results.append(entry)
+        embedding_dir.cleanup()
+
+    output = args.output or os.path.join(
+        BENCHMARK_DIR, "results", f"benchmark_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "settings": vars(args),
+                "python": platform.python_version(),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    print(f"Wrote {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from Auxiliary import logger
+
+# config keys that change how fast a run goes or where its results end up, but not the results
+IGNORED_KEYS = {
+    "N_runs",
+    "MAX_CONCURRENCY",
+    "RPM_LIMIT",
+    "TPM_LIMIT",
+    "HTTP_POOL_LIMIT",
+    "HTTP_POOL_LIMIT_PER_HOST",
+    "DNS_CACHE_TTL",
+    "LLM_BACKEND",
+    "BATCH_DIRECTORY",
+    "BATCH_MIN_REQUESTS",
+    "BATCH_POLL_SECONDS",
+    "EVAL_ERROR_POLICY",
+    "EVAL_BOOTSTRAP",
+    "RESULTS_STORE",
+    "RESULTS_CSV_EXPORT",
+    "RUN_TAG",
+    "CHECKPOINT_DIR",
+    "CHECKPOINT_BATCH_SIZE",
+}
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot checkpoint {type(value).__name__}")
+
+
+def run_key(class_name, config, documents):
+    """This function returns the hash of everything that determines the outputs of a run."""
+    digest = hashlib.sha256()
+    settings = {key: value for key, value in config.items() if key not in IGNORED_KEYS}
+    digest.update(json.dumps([class_name, settings], sort_keys=True, default=str).encode("utf-8"))
+    for document in documents:
+        digest.update(hashlib.sha256(document.encode("utf-8")).digest())
+    return digest.hexdigest()[:32]
+
+
+class PhaseCheckpoint:
+    """Saves the output of every finished phase of a run, so a restarted run resumes after it.
+
+    Each run gets its own directory, keyed by the model class, the config and the
+    sampled documents (see `run_key`). Phase outputs are JSON files that are written
+    atomically, so a run that is killed while saving leaves the previous checkpoint
+    intact. With `directory=None` nothing is saved or loaded.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def for_run(cls, class_name, config, documents):
+        root = config.get("CHECKPOINT_DIR", "cache/checkpoints")
+        if not root:
+            return cls(None)
+        return cls(os.path.join(root, class_name, run_key(class_name, config, documents)))
+
+    def _path(self, name, extension="json"):
+        return os.path.join(self.directory, f"{name}.{extension}")
+
+    def load(self, name, default=None):
+        """Return the saved output of phase `name`, or `default` if the phase has not finished."""
+        if self.directory is None or not os.path.exists(self._path(name)):
+            return default
+        with open(self._path(name), encoding="utf-8") as f:
+            value = json.load(f)
+        logger.info(f"Resuming from checkpoint {self._path(name)}")
+        return value
+
+    def save(self, name, value):
+        if self.directory is not None:
+            path = self._path(name)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(value, f, default=_to_json)
+            os.replace(path + ".tmp", path)
+        return value
+
+    def map_batches(self, name, items, function, batch_size=500, single_call=False):
+        """This function applies `function` to consecutive batches of `items` and concatenates the results.
+
+        Every finished batch is appended to a JSONL file, so a restarted run only
+        processes the batches that had not finished. `function` must return one result
+        per item. With `single_call=True` the items of all unfinished batches are passed
+        to `function` at once, e.g. to send them as one bulk job, and the results are then
+        saved per batch. Without a directory all items are passed to `function` at once.
+        """
+        if self.directory is None:
+            return list(function(items))
+        path = self._path(name, "jsonl")
+        finished = {}
+        if os.path.exists(path):
+            with open(path, "rb+") as f:
+                data = f.read()
+                # the last line is incomplete if the run was killed while writing it; cut it
+                # off, so the next batch is not appended to it
+                end = data.rfind(b"\n") + 1
+                if end < len(data):
+                    f.truncate(end)
+            for line in data[:end].decode("utf-8").splitlines():
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                finished[entry["start"]] = entry["results"]
+        if finished:
+            logger.info(f"Resuming {name} with {len(finished)} finished batches from {path}")
+
+        starts = range(0, len(items), batch_size)
+        pending = [
+            start
+            for start in starts
+            if len(finished.get(start, ())) != len(items[start : start + batch_size])
+        ]
+        with open(path, "a", encoding="utf-8") as f:
+
+            def save(start, batch_results):
+                f.write(json.dumps({"start": start, "results": batch_results}, default=_to_json) + "\n")
+                f.flush()
+                finished[start] = batch_results
+
+            if single_call and pending:
+                combined = list(
+                    function([item for start in pending for item in items[start : start + batch_size]])
+                )
+                offset = 0
+                for start in pending:
+                    size = len(items[start : start + batch_size])
+                    save(start, combined[offset : offset + size])
+                    offset += size
+            else:
+                for start in pending:
+                    save(start, list(function(items[start : start + batch_size])))
+        return [result for start in starts for result in finished[start]]
@@ -0,0 +1,87 @@
+import os
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.random_projection import SparseRandomProjection
+
+
+class HashingEmbeddingProvider:
+    """Local embeddings: hashed word uni- and bigram counts, randomly projected to `dim` dimensions.
+
+    Needs no fitting and no network access, so topics and documents embedded in
+    different calls always live in the same space.
+    """
+
+    def __init__(self, dim=512, n_features=2**18, seed=0):
+        self.vectorizer = HashingVectorizer(
+            n_features=n_features,
+            ngram_range=(1, 2),
+            stop_words="english",
+            alternate_sign=False,
+            norm="l2",
+            dtype=np.float32,
+        )
+        self.projection = SparseRandomProjection(
+            n_components=dim, dense_output=True, random_state=seed
+        )
+        # the projection matrix only depends on the input width and the seed
+        self.projection.fit(sparse.csr_matrix((1, n_features), dtype=np.float32))
+
+    def embed(self, texts):
+        hashed = self.vectorizer.transform(texts)
+        return np.asarray(self.projection.transform(hashed), dtype=np.float32)
+
+
+class OpenAIEmbeddingProvider:
+    def __init__(self, model="text-embedding-3-small", batch_size=512, client=None):
+        if client is None:
+            from openai import OpenAI
+
+            client = OpenAI(api_key=os.getenv("OPENAI_KEY"))
+        self.client = client
+        self.model = model
+        self.batch_size = batch_size
+
+    def embed(self, texts):
+        embeddings = []
+        for start in range(0, len(texts), self.batch_size):
+            response = self.client.embeddings.create(
+                model=self.model, input=texts[start : start + self.batch_size]
+            )
+            embeddings.extend(item.embedding for item in response.data)
+        return np.asarray(embeddings, dtype=np.float32)
+
+
+EMBEDDING_PROVIDERS = {
+    "hashing": HashingEmbeddingProvider,
+    "openai": OpenAIEmbeddingProvider,
+}
+
+
+def get_embedding_provider(config):
+    name = config.get("EMBEDDING_PROVIDER", "hashing")
+    if name not in EMBEDDING_PROVIDERS:
+        raise ValueError(
+            f"Unknown embedding provider {name}, choose from {list(EMBEDDING_PROVIDERS)}"
+        )
+    if name == "openai":
+        return OpenAIEmbeddingProvider(config.get("EMBEDDING_MODEL", "text-embedding-3-small"))
+    return HashingEmbeddingProvider()
+
+
+def normalize_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def similarity_matrix(document_embeddings, topic_embeddings):
+    """Cosine similarity of every document to every topic, shape (n_documents, n_topics)."""
+    return normalize_rows(document_embeddings) @ normalize_rows(topic_embeddings).T
+
+
+def classify_by_embedding(documents, topic_list, provider):
+    """This function assigns every document to the topic whose name embedding is most similar."""
+    similarities = similarity_matrix(provider.embed(documents), provider.embed(topic_list))
+    return similarities.argmax(axis=1)
@@ -0,0 +1,118 @@
+import os
+import re
+import threading
+
+import numpy as np
+
+from Auxiliary import logger
+from token_index import content_hashes
+
+
+class EmbeddingStore:
+    """Append-only on-disk matrix of document embeddings, keyed by content hash.
+
+    Every embedding model gets its own pair of files in `directory`: a raw row-major
+    matrix (float32, or int8 with one float32 scale per row when `quantize` is set)
+    that is read through `np.memmap`, and an .npz index with the content hash of
+    every row. Rows are only ever appended, and the index is replaced atomically
+    after the rows are written, so an interrupted write never corrupts the store.
+    """
+
+    _lock = threading.Lock()
+    _instances = {}
+
+    @classmethod
+    def open(cls, directory, model_name, quantize=False):
+        """Return the store shared by every model in this process that uses the same files."""
+        key = (os.path.abspath(directory), model_name, quantize)
+        with cls._lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(directory, model_name, quantize)
+            return cls._instances[key]
+
+    def __init__(self, directory, model_name, quantize=False):
+        self.directory = directory
+        self.model_name = model_name
+        self.quantize = quantize
+        self.dtype = np.int8 if quantize else np.float32
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", model_name)
+        suffix = "i8" if quantize else "f32"
+        self.data_path = os.path.join(directory, f"{name}.{suffix}")
+        self.index_path = os.path.join(directory, f"{name}.{suffix}.index.npz")
+        self.dim = None
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.scales = np.empty(0, dtype=np.float32)
+        self.rows = {}
+        self._write_lock = threading.Lock()
+        self._load_index()
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return
+        with np.load(self.index_path) as index:
+            self.dim = int(index["dim"])
+            self.hashes = index["hashes"]
+            self.scales = index["scales"]
+        self.rows = {int(h): row for row, h in enumerate(self.hashes)}
+
+    def _save_index(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, dim=np.array(self.dim), hashes=self.hashes, scales=self.scales)
+        os.replace(tmp_path, self.index_path)
+
+    def _matrix(self):
+        if len(self) == 0:
+            return np.empty((0, self.dim or 0), dtype=self.dtype)
+        return np.memmap(
+            self.data_path, dtype=self.dtype, mode="r", shape=(len(self), self.dim)
+        )
+
+    def get(self, hashes):
+        """Return the stored float32 embeddings of `hashes`; every hash must be present."""
+        rows = np.array([self.rows[int(h)] for h in hashes], dtype=np.int64)
+        embeddings = np.asarray(self._matrix()[rows], dtype=np.float32)
+        if self.quantize:
+            embeddings *= self.scales[rows, None]
+        return embeddings
+
+    def append(self, hashes, embeddings):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+        if self.quantize:
+            scales = np.abs(embeddings).max(axis=1) / 127
+            scales[scales == 0] = 1.0
+            data = np.round(embeddings / scales[:, None]).astype(np.int8)
+        else:
+            scales = np.ones(len(embeddings), dtype=np.float32)
+            data = embeddings
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.data_path, "ab") as f:
+            # drop rows of an earlier write that never made it into the index
+            f.truncate(len(self) * self.dim * np.dtype(self.dtype).itemsize)
+            f.write(np.ascontiguousarray(data).tobytes())
+        for offset, h in enumerate(hashes):
+            self.rows[int(h)] = len(self) + offset
+        self.hashes = np.concatenate([self.hashes, np.asarray(hashes, dtype=np.uint64)])
+        self.scales = np.concatenate([self.scales, scales.astype(np.float32)])
+        self._save_index()
+
+    def embed(self, texts, embed_function):
+        """This function returns embeddings for `texts`, calling `embed_function` only for unseen texts."""
+        hashes = content_hashes(texts)
+        with self._write_lock:
+            missing = {}
+            for text, h in zip(texts, hashes):
+                if int(h) not in self.rows and int(h) not in missing:
+                    missing[int(h)] = text
+            logger.info(
+                f"Embedding store: embedding {len(missing)} new documents out of {len(texts)}"
+            )
+            if missing:
+                new_embeddings = embed_function(list(missing.values()))
+                self.append(list(missing.keys()), new_embeddings)
+            return self.get(hashes)
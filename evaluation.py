@@ -0,0 +1,198 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# metrics in the order they are written to the score CSVs
+METRICS = [
+    "V_measure",
+    "completeness",
+    "homogeneity",
+    "adjusted_mutual_info",
+    "normalized_mutual_info",
+    "adjusted_rand",
+    "purity",
+]
+
+
+def apply_error_policy(labels, topics, error_policy="exclude"):
+    """This function decides what happens to documents whose topic is a negative error code
+    (-1, -2 and -3 from `assign_topic`).
+
+    "exclude" drops them (the coverage metric reports how many were kept), "singleton"
+    puts every one of them in a cluster of its own, and "cluster" keeps each error code
+    as one cluster, which is how the scikit-learn metrics used to treat them.
+    Returns the labels and topics to score, and the fraction of documents classified.
+    """
+    labels = np.asarray(labels)
+    topics = np.asarray(topics, dtype=np.int64)
+    classified = topics >= 0
+    coverage = classified.mean() if len(topics) else 0.0
+    if error_policy == "exclude":
+        return labels[classified], topics[classified], coverage
+    if error_policy == "singleton":
+        topics = topics.copy()
+        n_failed = int((~classified).sum())
+        topics[~classified] = topics.max(initial=0) + 1 + np.arange(n_failed)
+        return labels, topics, coverage
+    if error_policy == "cluster":
+        return labels, topics, coverage
+    raise ValueError(f"Unknown error policy {error_policy}")
+
+
+def contingency_table(labels, topics):
+    """This function returns the sparse (n_classes, n_clusters) table of document counts."""
+    _, class_idx = np.unique(labels, return_inverse=True)
+    _, cluster_idx = np.unique(topics, return_inverse=True)
+    table = sparse.coo_matrix(
+        (np.ones(len(class_idx), dtype=np.int64), (class_idx.ravel(), cluster_idx.ravel())),
+        shape=(class_idx.max(initial=-1) + 1, cluster_idx.max(initial=-1) + 1),
+    ).tocsr()
+    table.sum_duplicates()
+    return table
+
+
+def _entropy(counts, n):
+    """Entropy of each row of `counts` (replicates x groups), in nats."""
+    p = counts / n[:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return -np.where(p > 0, p * np.log(p), 0.0).sum(axis=1)
+
+
+def _comb2(x):
+    return x * (x - 1) / 2
+
+
+def metrics_from_cells(cells, rows, cols, n_rows, n_cols, emi=None):
+    """This function computes every metric from the nonzero cells of one or more contingency tables.
+
+    `cells` is (replicates, nnz): the counts of the nonzero cells of the observed table,
+    at positions `rows` and `cols`, for each (resampled) table. All metrics are computed
+    for all replicates at once. `emi` is the expected mutual information used for AMI.
+    """
+    cells = np.asarray(cells, dtype=np.float64)
+    n = cells.sum(axis=1)
+    row_indicator = sparse.csr_matrix(
+        (np.ones(len(rows)), (np.arange(len(rows)), rows)), shape=(len(rows), n_rows)
+    )
+    col_indicator = sparse.csr_matrix(
+        (np.ones(len(cols)), (np.arange(len(cols)), cols)), shape=(len(cols), n_cols)
+    )
+    class_sums = np.asarray((row_indicator.T @ cells.T).T)
+    cluster_sums = np.asarray((col_indicator.T @ cells.T).T)
+
+    h_class = _entropy(class_sums, n)
+    h_cluster = _entropy(cluster_sums, n)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        outer = class_sums[:, rows] * cluster_sums[:, cols]
+        mi = np.where(
+            cells > 0, cells / n[:, None] * (np.log(cells * n[:, None]) - np.log(outer)), 0.0
+        ).sum(axis=1)
+    mi = np.maximum(mi, 0.0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        homogeneity = np.where(h_class > 0, mi / h_class, 1.0)
+        completeness = np.where(h_cluster > 0, mi / h_cluster, 1.0)
+        v_measure = np.where(
+            homogeneity + completeness > 0,
+            2 * homogeneity * completeness / (homogeneity + completeness),
+            0.0,
+        )
+        mean_entropy = (h_class + h_cluster) / 2
+        nmi = np.where(mean_entropy > 0, mi / mean_entropy, 1.0)
+        if emi is None:
+            ami = np.full_like(mi, np.nan)
+        else:
+            denominator = mean_entropy - emi
+            ami = np.where(np.abs(denominator) > 1e-15, (mi - emi) / denominator, 1.0)
+
+        sum_cells = _comb2(cells).sum(axis=1)
+        sum_classes = _comb2(class_sums).sum(axis=1)
+        sum_clusters = _comb2(cluster_sums).sum(axis=1)
+        expected = sum_classes * sum_clusters / _comb2(n)
+        maximum = (sum_classes + sum_clusters) / 2
+        # a table of fewer than two documents has no pairs, which scikit-learn scores as 1.0
+        ari = np.where(
+            (n >= 2) & (maximum != expected), (sum_cells - expected) / (maximum - expected), 1.0
+        )
+
+    # purity: every cluster counts the documents of its most frequent class
+    order = np.argsort(cols, kind="stable")
+    starts = np.flatnonzero(np.r_[True, np.diff(cols[order]) != 0])
+    purity = np.maximum.reduceat(cells[:, order], starts, axis=1).sum(axis=1) / n
+
+    return {
+        "V_measure": v_measure,
+        "completeness": completeness,
+        "homogeneity": homogeneity,
+        "adjusted_mutual_info": ami,
+        "normalized_mutual_info": nmi,
+        "adjusted_rand": ari,
+        "purity": purity,
+    }
+
+
+def expected_mutual_info(table):
+    from sklearn.metrics.cluster._expected_mutual_info_fast import expected_mutual_information
+
+    return expected_mutual_information(table, int(table.sum()))
+
+
+def evaluate(
+    labels, topics, error_policy="exclude", n_bootstrap=1_000, confidence=0.95, seed=0
+):
+    """This function scores topic assignments against the ground truth from one contingency table.
+
+    Returns {metric: (score, ci_low, ci_high)}, including the "coverage" of classified
+    documents. Confidence intervals are percentile intervals over `n_bootstrap`
+    resamples of the documents, drawn as multinomial samples of the table's cells; the
+    AMI intervals reuse the expected mutual information of the observed table. With
+    few documents per cell, resampling inflates the mutual information, so the
+    intervals of the entropy-based metrics can lie above the point estimate.
+    """
+    labels, topics, coverage = apply_error_policy(labels, topics, error_policy)
+    if len(topics) == 0:
+        results = {metric: (np.nan, np.nan, np.nan) for metric in METRICS}
+        results["coverage"] = (float(coverage), np.nan, np.nan)
+        return results
+    table = contingency_table(labels, topics).tocoo()
+    rows, cols, counts = table.row, table.col, table.data.astype(np.float64)
+    emi = expected_mutual_info(table.tocsr())
+    observed = metrics_from_cells(counts[None, :], rows, cols, *table.shape, emi=emi)
+
+    results = {metric: (float(values[0]), np.nan, np.nan) for metric, values in observed.items()}
+    if n_bootstrap:
+        generator = np.random.default_rng(seed)
+        resampled = generator.multinomial(int(counts.sum()), counts / counts.sum(), size=n_bootstrap)
+        bootstrap = metrics_from_cells(resampled, rows, cols, *table.shape, emi=emi)
+        alpha = (1 - confidence) / 2
+        for metric, values in bootstrap.items():
+            low, high = np.nanquantile(values, [alpha, 1 - alpha])
+            results[metric] = (results[metric][0], float(low), float(high))
+    results["coverage"] = (float(coverage), np.nan, np.nan)
+    return results
+
+
+def score_rows(labels, topics, num_topics, **kwargs):
+    """Returns (metric_name, score, num_topics, ci_low, ci_high) rows for the score CSVs."""
+    return [
+        (metric, score, num_topics, low, high)
+        for metric, (score, low, high) in evaluate(labels, topics, **kwargs).items()
+    ]
+
+
+def rescore(topic_names_path, **kwargs):
+    """This function scores saved assignments again, e.g. with another error policy.
+
+    `topic_names_path` is a topic_names CSV written by `TopicModelingInterface.run`;
+    it returns a DataFrame with one row per run and metric.
+    """
+    # labels such as "nan" or "NA" (the class of unlabeled documents) stay strings
+    df = pd.read_csv(topic_names_path, keep_default_na=False, dtype={"ground_truth": str})
+    rows = []
+    for run, group in df.groupby("run"):
+        num_topics = group.loc[group["topic"] >= 0, "topic"].nunique()
+        for row in score_rows(group["ground_truth"], group["topic"], num_topics, **kwargs):
+            rows.append((run, *row))
+    return pd.DataFrame(
+        rows, columns=["run", "metric_name", "score", "num_topics", "ci_low", "ci_high"]
+    )
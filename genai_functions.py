@@ -1,19 +1,85 @@
+from functools import partial
 from itertools import chain
-from openai import OpenAI
 
 import json
-import aiohttp
+import math
+import numpy as np
 import asyncio
 import os
+import threading
+import time
 
 from Auxiliary import delay_execution, delay_execution_async
+from batch_jobs import BatchJobRunner, DirectoryBatchBackend, OpenAIBatchBackend
+from ledger import batch_model_name, record_request
+from llm_cache import CompletionCache, make_cache_key
+from llm_client import get_client
+from request_scheduler import APIStatusError, RequestScheduler, parse_retry_after
 from dotenv import load_dotenv
 
 load_dotenv(".env")
 
-API_KEY = os.getenv("OPENAI_KEY")
-client = OpenAI(api_key=API_KEY)
+# point OPENAI_BASE_URL at any OpenAI-compatible server, e.g. the fake server in benchmarks/
+API_BASE = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
 TEMPERATURE = 0
+SYSTEM_PROMPT = "You are a helpful assistant designed to output JSON."
+# for requests without a JSON response format, e.g. the single-token index answers
+PLAIN_SYSTEM_PROMPT = "You are a helpful assistant. Answer exactly in the format the user asks for."
+JSON_RESPONSE_FORMAT = {"type": "json_object"}
+# expected completion size used when budgeting tokens per minute
+COMPLETION_TOKEN_ESTIMATE = 200
+
+# Completions are cached on disk; only deterministic (temperature 0) requests are
+# cached unless LLM_CACHE_ALL_TEMPERATURES is set, so retries at a higher
+# temperature still get a fresh answer.
+cache = CompletionCache(
+    os.getenv("LLM_CACHE_PATH", "cache/llm_completions.sqlite"),
+    max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 1_000_000)),
+    max_age=float(os.getenv("LLM_CACHE_MAX_AGE")) if os.getenv("LLM_CACHE_MAX_AGE") else None,
+    enabled=os.getenv("LLM_CACHE", "1") != "0",
+)
+CACHE_ALL_TEMPERATURES = os.getenv("LLM_CACHE_ALL_TEMPERATURES", "0") == "1"
+# Prompts put their constant part first so that providers can reuse it from their
+# prompt-prefix cache; with LLM_PREFIX_IN_SYSTEM=1 that part is sent as the system message.
+PREFIX_IN_SYSTEM = os.getenv("LLM_PREFIX_IN_SYSTEM", "0") == "1"
+
+
+class Prompt(str):
+    """A prompt string made of a static prefix, shared by many requests, and a dynamic suffix.
+
+    It behaves as the full prompt text everywhere a string is expected.
+    """
+
+    def __new__(cls, static, dynamic):
+        prompt = super().__new__(cls, static + dynamic)
+        prompt.static = static
+        prompt.dynamic = dynamic
+        return prompt
+
+    def __getnewargs__(self):
+        return (self.static, self.dynamic)
+
+
+def chat_messages(prompt, response_format=JSON_RESPONSE_FORMAT):
+    system_prompt = SYSTEM_PROMPT if response_format is not None else PLAIN_SYSTEM_PROMPT
+    if PREFIX_IN_SYSTEM and isinstance(prompt, Prompt) and prompt.static:
+        return [
+            {"role": "system", "content": f"{system_prompt}\n\n{prompt.static}"},
+            {"role": "user", "content": prompt.dynamic},
+        ]
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def cache_key(messages, model, temperature, response_format=JSON_RESPONSE_FORMAT, **kwargs):
+    """This function returns the cache key for a request, or None if the request should not be cached."""
+    if temperature != 0 and not CACHE_ALL_TEMPERATURES:
+        return None
+    return make_cache_key(
+        model, messages, temperature, response_format=response_format, **kwargs
+    )
 
 
 def chunk_documents(
@@ -41,11 +107,82 @@ def chunk_documents(
     return chunks
 
 
+def pack_documents(
+    documents, encoding, max_tokens, max_documents=10, keep_order=False, return_stats=False
+):
+    """This function packs documents into as few chunks as possible under max_tokens and max_documents.
+
+    Every document is tokenized exactly once with the batched encoder of `encoding` (a
+    tiktoken Encoding), and documents of max_tokens or more are truncated from those
+    same tokens and get a chunk of their own. Documents are packed first-fit-decreasing;
+    with keep_order=True consecutive documents are grouped in their original order
+    instead, exactly like `chunk_documents`.
+    """
+    documents = list(documents)
+    token_lists = encoding.encode_batch(documents, num_threads=os.cpu_count() or 1)
+    sizes = []
+    for i, tokens in enumerate(token_lists):
+        if len(tokens) >= max_tokens:
+            documents[i] = encoding.decode(tokens[:max_tokens])
+            sizes.append(max_tokens)
+        else:
+            sizes.append(len(tokens))
+
+    if keep_order:
+        chunks = [[]]
+        loads = [0]
+        for i, size in enumerate(sizes):
+            if loads[-1] + size < max_tokens and len(chunks[-1]) < max_documents:
+                chunks[-1].append(i)
+                loads[-1] += size
+            else:
+                chunks.append([i])
+                loads.append(size)
+    else:
+        chunks = []
+        loads = []
+        for i in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+            for c in range(len(chunks)):
+                if loads[c] + sizes[i] < max_tokens and len(chunks[c]) < max_documents:
+                    break
+            else:
+                chunks.append([])
+                loads.append(0)
+                c = len(chunks) - 1
+            chunks[c].append(i)
+            loads[c] += sizes[i]
+
+    chunks = [[documents[i] for i in chunk] for chunk in chunks if chunk]
+    stats = packing_stats(sizes, len(chunks), max_tokens, max_documents)
+    print(
+        f"Packed {len(documents)} documents into {stats['n_chunks']} chunks "
+        f"(lower bound {stats['min_chunks']}, {stats['fill']:.0%} of the token budget used)"
+    )
+    if return_stats:
+        return chunks, stats
+    return chunks
+
+
+def packing_stats(sizes, n_chunks, max_tokens, max_documents):
+    total_tokens = sum(sizes)
+    # with a limit below 1 the packer still puts one document in every chunk
+    min_chunks = max(
+        -(-total_tokens // max(1, max_tokens)),
+        -(-len(sizes) // max(1, max_documents)),
+        1 if sizes else 0,
+    )
+    return {
+        "n_chunks": n_chunks,
+        "min_chunks": min_chunks,
+        "fill": total_tokens / (n_chunks * max_tokens) if n_chunks else 0.0,
+    }
+
+
 def topic_creation_prompt(documents, type="news articles"):
     """This function takes a list of documents and returns a prompt that can be used to return a list of topics."""
 
-    prompt = f"""Your task will be to distill a list of topics from the following {type}:\n\n"""
-    prompt += " DOCUMENT: " + "\n DOCUMENT: ".join(documents) + "\n\n"
+    static = f"""Your task will be to distill a list of topics from the following {type}:\n\n"""
+    prompt = " DOCUMENT: " + "\n DOCUMENT: ".join(documents) + "\n\n"
     prompt += (
         "Your response should be a JSON in the following format: {\"topics\": [\"topic1\", \"topic2\", \"topic3\"]}"
         + "\n"
@@ -53,7 +190,7 @@ def topic_creation_prompt(documents, type="news articles"):
     prompt += "Topics should not be too specific, but also not too general. For example, 'food' is too general, but 'lemon cake' is too specific.\n"
     prompt += "A topic does not need to be present in multiple documents. But do not create more topics than there are documents, so if there are N documents, you should at most create N topics." + "\n"
 
-    return prompt
+    return Prompt(static, prompt)
 
 def topic_creation_prompt_old(documents, type="news articles"):
     """This function takes a list of documents and returns a prompt that can be used to return a list of topics."""
@@ -72,8 +209,8 @@ def topic_creation_prompt_old(documents, type="news articles"):
 
 def topic_combination_prompt(topic_list, n_topics):
 
-    prompt = "Your task will be too distill a list of core topics from the following topics:\n\n"
-    prompt += "\n TOPIC:".join(topic_list) + "\n\n"
+    static = "Your task will be too distill a list of core topics from the following topics:\n\n"
+    prompt = "\n TOPIC:".join(topic_list) + "\n\n"
     prompt += (
         "Your response should be a JSON in the following format: {\"topics\": [\"topic1\", \"topic2\", \"topic3\"]}"
         + "\n"
@@ -81,34 +218,75 @@ def topic_combination_prompt(topic_list, n_topics):
     prompt += "Remove duplicate topics and merge topics that are too general. Merge topics together that are too specific. For example, 'food' might too general, but 'lemon cake' might too specific."
     prompt += f"In the end, try to arrive at a list of about {n_topics} topics."
 
-    return prompt
+    return Prompt(static, prompt)
 
 
 def topic_combination_prompt_noprior(topic_list):
 
-    prompt = "Your task will be too distill a list of core topics from the following topics:\n\n"
-    prompt += "\n TOPIC:".join(topic_list) + "\n\n"
+    static = "Your task will be too distill a list of core topics from the following topics:\n\n"
+    prompt = "\n TOPIC:".join(topic_list) + "\n\n"
     prompt += (
         "Your response should be a JSON in the following format: {\"topics\": [\"topic1\", \"topic2\", \"topic3\"]}"
         + "\n"
     )
     prompt += "Remove duplicate topics and merge topics that are too general. Merge topics together that are too specific. For example, 'food' might too general, but 'lemon cake' might too specific. Arrive at a reasonable amount of core topics, whatever best suits the data."
 
-    return prompt
+    return Prompt(static, prompt)
+
+
+def topic_listing(topics):
+    return "\n".join([f"#{index}: {topic}" for index, topic in enumerate(topics)])
 
 
 def topic_classification_prompt(document, topics):
-    topics = enumerate(topics)
+    """This function returns a classification prompt; the topic list and instructions come first
+    so that all documents classified against the same topics share one cacheable prefix."""
+    static = topic_classification_instructions(topics)
+    return Prompt(static, f"DOCUMENT: {document}")
+
+
+def topic_classification_instructions(topics):
     prompt = f"Your task will be to classify the following document into one of the following topics:\n\n"
-    prompt += f"DOCUMENT: {document}\n\n"
-    prompt += "\n".join([f"#{index}: {topic}" for index, topic in topics]) + "\n\n"
+    prompt += topic_listing(topics) + "\n\n"
     prompt += (
         "Your response should be a JSON in the following format: {\"topic\": idx} with idx integer." + "\n"
     )
-    prompt += "The index should be the index of the topic in the list of topics."
+    prompt += "The index should be the index of the topic in the list of topics.\n\n"
     return prompt
 
 
+def topic_classification_repair_prompt(document, topics):
+    """This function returns a stricter classification prompt for documents whose first answer was unusable."""
+    prompt = topic_classification_instructions(topics)
+    prompt += (
+        f"Your previous answer could not be used. Answer with exactly one key, \"topic\","
+        f" whose value is a single integer between 0 and {len(topics) - 1}."
+        " Pick the closest topic even if none fits well.\n\n"
+    )
+    return Prompt(prompt, f"DOCUMENT: {document}")
+
+
+def topic_classification_index_prompt(document, topics):
+    """This function returns a classification prompt whose answer is the bare topic index, a single token."""
+    prompt = f"Your task will be to classify the following document into one of the following topics:\n\n"
+    prompt += topic_listing(topics) + "\n\n"
+    prompt += "Answer with the index of the topic in the list of topics and nothing else: no JSON, no words, only the integer.\n\n"
+    return Prompt(prompt, f"DOCUMENT: {document}")
+
+
+def topic_classification_batch_prompt(documents, topics):
+    """This function takes a list of (doc_id, document) pairs and returns a prompt that classifies all of them at once."""
+    prompt = f"Your task will be to classify each of the following documents into one of the following topics:\n\n"
+    prompt += topic_listing(topics) + "\n\n"
+    prompt += (
+        "Your response should be a JSON in the following format: {\"classifications\": [{\"doc_id\": id, \"topic\": idx}]} with id and idx integers." + "\n"
+    )
+    prompt += "The index should be the index of the topic in the list of topics. Classify every document exactly once, using the number after DOCUMENT as its id.\n\n"
+    return Prompt(
+        prompt, "\n\n".join([f"DOCUMENT {doc_id}: {document}" for doc_id, document in documents])
+    )
+
+
 def topic_elimination_prompt_oldest(topics):
     topics = enumerate(topics)
     prompt = (
@@ -124,17 +302,30 @@ def topic_elimination_prompt_oldest(topics):
 
 
 def topic_elimination_prompt(topics):
-    topics = enumerate(topics)
+    """This function returns a pairwise merge prompt; the instructions come before the
+    topic list, which changes after every merge."""
     prompt = (
-        f"Your task will be to merge a pair of topics out of the following topics because the current topics are too granular:\n\n"
+        f"Your task will be to merge a pair of topics out of the following topics because the current topics are too granular.\n"
     )
-    prompt += "\n".join([f"#{index}: {topic}" for index, topic in topics]) + "\n\n"
     prompt += "Your response should be a JSON in the following format: {\"topic_pair\": [idx1, idx2], \"new_topic\": \"new_topic\"}\n with idx1, idx2 integers."
     prompt += "The index should be the index of the topic in the list of topics.\n"
     prompt += "The new topic should be a generalization of the two topics. Keep the name of the topic simple, try to generalize. So if you merge topic 'A' and 'B' together, do not name the topic something like 'A and B'. Rather, find the common more general denominator.\n"
     prompt += "In selecting the pair to merge, please merge the most similar, and most granular topics first."
-    prompt += "If you encounter a topic that is too general (e.g., 'A and B' without A and B having a strong relationship), merge it with the most appropriate and similar topic to create a more specific topic instead of generalizing."
-    return prompt
+    prompt += "If you encounter a topic that is too general (e.g., 'A and B' without A and B having a strong relationship), merge it with the most appropriate and similar topic to create a more specific topic instead of generalizing.\n\n"
+    return Prompt(prompt, topic_listing(topics))
+
+def topic_elimination_round_prompt(topics, max_merges):
+    prompt = (
+        f"Your task will be to merge up to {max_merges} pairs of topics out of the following topics because the current topics are too granular.\n"
+    )
+    prompt += "Your response should be a JSON in the following format: {\"merges\": [{\"topic_pair\": [idx1, idx2], \"new_topic\": \"new_topic\"}]}\n with idx1, idx2 integers."
+    prompt += "The index should be the index of the topic in the list of topics.\n"
+    prompt += f"Propose at most {max_merges} merges. Every topic may appear in at most one pair, so the pairs must not share any index. Only merge pairs that are truly similar; it is fine to propose fewer merges.\n"
+    prompt += "The new topic should be a generalization of the two topics. Keep the name of the topic simple, try to generalize. So if you merge topic 'A' and 'B' together, do not name the topic something like 'A and B'. Rather, find the common more general denominator.\n"
+    prompt += "In selecting the pairs to merge, please merge the most similar, and most granular topics first."
+    prompt += "If you encounter a topic that is too general (e.g., 'A and B' without A and B having a strong relationship), merge it with the most appropriate and similar topic to create a more specific topic instead of generalizing.\n\n"
+    return Prompt(prompt, topic_listing(topics))
+
 
 def topic_elimination_prompt_weighted(topic_list, topic_weights):
     # zip the topics and weights together
@@ -166,126 +357,596 @@ def topic_buildup_prompt(topics, curr_list, final_size):
     return prompt
     
 
-@delay_execution(seconds=5, tries=2)
-def complete_openai_request(prompt, model="gpt-4o", timeout=30, temperature=0):
-    response = client.chat.completions.create(
-        model=model,
-        response_format={"type": "json_object"},
-        messages=[
-            {
-                "role": "system",
-                "content": "You are a helpful assistant designed to output JSON.",
-            },
-            {"role": "user", "content": prompt},
-        ],
-        timeout=timeout,
-        temperature=temperature,
-        max_tokens=2_000,
-    )
+def api_key():
+    # read on every request, so importing this module needs no key
+    return os.getenv("OPENAI_KEY")
 
-    json_string = response.choices[0].message.content
-    json_dict = json.loads(json_string)
-    return json_dict
 
+async def request_openai_http(
+    session,
+    prompt,
+    model,
+    timeout,
+    logprobs=False,
+    temperature=TEMPERATURE,
+    max_tokens=None,
+    response_format=JSON_RESPONSE_FORMAT,
+):
+    """This function performs a single chat completion request without retries.
 
-@delay_execution_async(seconds=5, tries=30)
-async def complete_openai_request_http(session, prompt, model, timeout):
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {API_KEY}"}
-    data = {
-        "model": model,
-        "response_format": {"type": "json_object"},
-        "messages": [
-            {
-                "role": "system",
-                "content": "You are a helpful assistant designed to output JSON.",
-            },
-            {"role": "user", "content": prompt},
-        ],
-        "temperature": TEMPERATURE,
-    }
+    Non-200 responses raise an APIStatusError carrying the Retry-After hint, so the
+    caller (usually the RequestScheduler) decides whether and when to retry.
+    With logprobs=True the full response is returned instead of the parsed JSON content;
+    pass response_format=None to let the model answer in plain text. The answer is
+    stored in the cache, but not looked up there: see `cached_completion`.
+    """
+    data, key = chat_request(prompt, model, temperature, logprobs, max_tokens, response_format)
+
+    import aiohttp
+
+    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key()}"}
     timeout = aiohttp.ClientTimeout(
         total=timeout
     )  # Set the total timeout for the whole operation
-    async with session.post(
-        "https://api.openai.com/v1/chat/completions",
-        headers=headers,
-        json=data,
-        timeout=timeout,
-    ) as response:
-        if response.status != 200:
-            print(await response.text())
-            print(prompt[:200])
-            response.raise_for_status()  # This will raise an exception for HTTP errors
-        response_json = await response.json()
-        response_json = response_json["choices"][0]["message"]["content"]
-        return json.loads(response_json)
-     
-@delay_execution_async(seconds=5, tries=30)
-async def complete_openai_request_http_logprobs(session, prompt, model, timeout):
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {API_KEY}"}
+    start = time.perf_counter()
+    try:
+        async with session.post(
+            f"{API_BASE}/chat/completions",
+            headers=headers,
+            json=data,
+            timeout=timeout,
+        ) as response:
+            if response.status != 200:
+                text = await response.text()
+                record_request(model, response.status, time.perf_counter() - start)
+                print(text)
+                print(prompt[:200])
+                raise APIStatusError(
+                    response.status, text, retry_after=parse_retry_after(response.headers)
+                )
+            response_json = await response.json()
+    except (asyncio.TimeoutError, aiohttp.ClientError):
+        record_request(model, "error", time.perf_counter() - start)
+        raise
+    record_request(
+        model, 200, time.perf_counter() - start, usage=response_json.get("usage")
+    )
+    result = parse_completion(response_json, logprobs)
+    if key is not None:
+        cache.set(key, result)
+    return result
+
+
+def chat_request(
+    prompt, model, temperature=TEMPERATURE, logprobs=False, max_tokens=None,
+    response_format=JSON_RESPONSE_FORMAT,
+):
+    """This function returns the body of a chat completion request and its cache key (None if uncached)."""
+    messages = chat_messages(prompt, response_format)
+    extra = {"logprobs": True, "top_logprobs": 20} if logprobs else {}
+    if max_tokens is not None:
+        extra["max_tokens"] = max_tokens
+    key = cache_key(messages, model, temperature, response_format=response_format, **extra)
     data = {
         "model": model,
-        "response_format": {"type": "json_object"},
-        "messages": [
-            {
-                "role": "system",
-                "content": "You are a helpful assistant designed to output JSON.",
-            },
-            {"role": "user", "content": prompt},
-        ],
-        "temperature": TEMPERATURE,
-        "logprobs": True,
-        "top_logprobs": 20,
+        "messages": messages,
+        "temperature": temperature,
+        **extra,
     }
-    timeout = aiohttp.ClientTimeout(
-        total=timeout
-    )  # Set the total timeout for the whole operation
-    async with session.post(
-        "https://api.openai.com/v1/chat/completions",
-        headers=headers,
-        json=data,
-        timeout=timeout,
-    ) as response:
-        if response.status != 200:
-            print(await response.text())
-            print(prompt[:200])
-            response.raise_for_status()  # This will raise an exception for HTTP errors
-        response_json = await response.json()
+    if response_format is not None:
+        data["response_format"] = response_format
+    return data, key
+
+
+def cached_completion(
+    prompt, model, temperature=TEMPERATURE, logprobs=False, max_tokens=None,
+    response_format=JSON_RESPONSE_FORMAT,
+):
+    """This function returns the cached answer to a request, or None.
+
+    Callers look up the cache before scheduling a request, so cache hits take no
+    rate-limit tokens or concurrency slot.
+    """
+    _, key = chat_request(prompt, model, temperature, logprobs, max_tokens, response_format)
+    cached = cache.get(key) if key is not None else None
+    if cached is not None:
+        record_request(model, 200, cache_hit=True)
+    return cached
+
+
+def parse_completion(response_json, logprobs=False):
+    if logprobs:
         return response_json
+    return json.loads(response_json["choices"][0]["message"]["content"])
+
+
+async def acomplete(
+    prompt,
+    model="gpt-4o",
+    timeout=30,
+    temperature=TEMPERATURE,
+    logprobs=False,
+    max_tokens=None,
+    response_format=JSON_RESPONSE_FORMAT,
+    retry_invalid=True,
+):
+    """This function completes one prompt through the shared client and the global scheduler.
+
+    It must be awaited on the shared client's loop, e.g. via `get_client().run(...)`.
+    """
+    cached = cached_completion(prompt, model, temperature, logprobs, max_tokens, response_format)
+    if cached is not None:
+        return cached
+    factory = partial(
+        request_openai_http,
+        get_client().session,
+        prompt,
+        model,
+        timeout,
+        logprobs=logprobs,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        response_format=response_format,
+    )
+    tokens = estimate_tokens([prompt], model)[0] if scheduler.token_bucket is not None else 0
+    return await scheduler.run(factory, tokens, retry_invalid=retry_invalid)
+
+
+async def acomplete_many(
+    prompts,
+    model="gpt-4o",
+    timeout=30,
+    temperature=TEMPERATURE,
+    logprobs=False,
+    max_tokens=None,
+    response_format=JSON_RESPONSE_FORMAT,
+):
+    """This function completes all prompts concurrently on the shared client's loop.
+
+    Results are returned in the order of `prompts`, with None for requests that failed.
+    Only the prompts that are not cached go through the scheduler.
+    """
+    results = [
+        cached_completion(prompt, model, temperature, logprobs, max_tokens, response_format)
+        for prompt in prompts
+    ]
+    pending = [i for i, result in enumerate(results) if result is None]
+    if not pending:
+        return results
+    session = get_client().session
+    factories = [
+        partial(
+            request_openai_http,
+            session,
+            prompts[i],
+            model,
+            timeout,
+            logprobs=logprobs,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            response_format=response_format,
+        )
+        for i in pending
+    ]
+    estimated_tokens = (
+        estimate_tokens([prompts[i] for i in pending], model)
+        if scheduler.token_bucket is not None
+        else None
+    )
+    for i, result in zip(pending, await scheduler.map(factories, estimated_tokens)):
+        results[i] = result
+    return results
+
+
+@delay_execution(seconds=5, tries=2)
+def complete_openai_request(prompt, model="gpt-4o", timeout=30, temperature=0):
+    # transport errors are retried by the scheduler, anything else by the decorator
+    return get_client().run(
+        acomplete(
+            prompt,
+            model=model,
+            timeout=timeout,
+            temperature=temperature,
+            max_tokens=2_000,
+            retry_invalid=False,
+        )
+    )
+
+
+@delay_execution_async(seconds=5, tries=30)
+async def complete_openai_request_http(session, prompt, model, timeout):
+    cached = cached_completion(prompt, model)
+    if cached is not None:
+        return cached
+    return await request_openai_http(session, prompt, model, timeout)
+
+
+@delay_execution_async(seconds=5, tries=30)
+async def complete_openai_request_http_logprobs(session, prompt, model, timeout):
+    cached = cached_completion(prompt, model, logprobs=True)
+    if cached is not None:
+        return cached
+    return await request_openai_http(session, prompt, model, timeout, logprobs=True)
+
+
+def configure_throughput(
+    max_concurrency=50, requests_per_minute=None, tokens_per_minute=None, max_retries=30
+):
+    """This function sets the global scheduler that all parallel requests share.
+
+    The current scheduler is kept when the settings are unchanged, so models that run
+    concurrently with the same config share one request budget.
+    """
+    global scheduler, scheduler_settings
+    settings = (max_concurrency, requests_per_minute, tokens_per_minute, max_retries)
+    with scheduler_lock:
+        if settings != scheduler_settings:
+            scheduler = RequestScheduler(
+                max_concurrency=max_concurrency,
+                requests_per_minute=requests_per_minute,
+                tokens_per_minute=tokens_per_minute,
+                max_retries=max_retries,
+            )
+            scheduler_settings = settings
+        return scheduler
+
+
+def configure_throughput_from_config(config):
+    return configure_throughput(
+        max_concurrency=config.get("MAX_CONCURRENCY", 50),
+        requests_per_minute=config.get("RPM_LIMIT"),
+        tokens_per_minute=config.get("TPM_LIMIT"),
+        max_retries=config.get("MAX_RETRIES", 30),
+    )
+
+
+scheduler = RequestScheduler()
+scheduler_settings = (50, None, None, 30)
+scheduler_lock = threading.Lock()
+
+
+def configure_backend(backend="online", directory=None, min_requests=100, poll_interval=30):
+    """This function chooses how `complete_openai_request_parralel` sends its prompts.
+
+    "online" sends every prompt as its own request. "batch" submits the prompts of
+    calls with at least `min_requests` prompts as one job to the batch endpoint, and
+    "batch_directory" hands them to a watcher of `directory` instead (for testing).
+    Smaller calls, and the sequential single requests, always go online.
+    """
+    global batch_runner, batch_min_requests
+    if backend == "online":
+        batch_runner = None
+    elif backend == "batch":
+        batch_runner = BatchJobRunner(
+            OpenAIBatchBackend(API_BASE, api_key()), poll_interval=poll_interval
+        )
+    elif backend == "batch_directory":
+        batch_runner = BatchJobRunner(
+            DirectoryBatchBackend(directory or "cache/batch_inbox"), poll_interval=poll_interval
+        )
+    else:
+        raise ValueError(f"Unknown LLM backend {backend}")
+    batch_min_requests = min_requests
+    return batch_runner
+
+
+def configure_backend_from_config(config):
+    return configure_backend(
+        backend=config.get("LLM_BACKEND", "online"),
+        directory=config.get("BATCH_DIRECTORY"),
+        min_requests=config.get("BATCH_MIN_REQUESTS", 100),
+        poll_interval=config.get("BATCH_POLL_SECONDS", 30),
+    )
+
+
+batch_runner = None
+batch_min_requests = 100
+
+
+def complete_openai_request_batch(
+    prompts,
+    model,
+    logprobs=False,
+    temperature=TEMPERATURE,
+    max_tokens=None,
+    response_format=JSON_RESPONSE_FORMAT,
+):
+    """This function completes the prompts that are not cached as one bulk job of `batch_runner`.
+
+    Results are returned in the order of `prompts`, with None for requests that failed.
+    """
+    results = [None] * len(prompts)
+    bodies, pending = [], []
+    for i, prompt in enumerate(prompts):
+        data, key = chat_request(prompt, model, temperature, logprobs, max_tokens, response_format)
+        cached = cache.get(key) if key is not None else None
+        if cached is not None:
+            record_request(model, 200, cache_hit=True)
+            results[i] = cached
+        else:
+            bodies.append(data)
+            pending.append((i, key))
+    if not bodies:
+        return results
+
+    responses = batch_runner.run(bodies)
+    for (i, key), response_json in zip(pending, responses):
+        if response_json is None:
+            record_request(batch_model_name(model), "error")
+            continue
+        record_request(batch_model_name(model), 200, usage=response_json.get("usage"))
+        try:
+            results[i] = parse_completion(response_json, logprobs)
+        except (ValueError, KeyError, IndexError) as e:
+            print(f"Unusable batch answer for prompt {i}: {e!r}")
+            continue
+        if key is not None:
+            cache.set(key, results[i])
+    return results
+
+
+def estimate_tokens(prompts, model, completion_tokens=COMPLETION_TOKEN_ESTIMATE):
+    """This function estimates the tokens each request counts against the tokens-per-minute budget."""
+    import tiktoken
+
+    try:
+        enc = tiktoken.encoding_for_model(model)
+    except KeyError:
+        enc = tiktoken.get_encoding("cl100k_base")
+    return [len(tokens) + completion_tokens for tokens in enc.encode_batch(prompts)]
+
 
 def complete_openai_request_parralel(
-    prompts, model="gpt-3.5-turbo", timeout=30, batch_size=100, logprobs=False
+    prompts,
+    model="gpt-3.5-turbo",
+    timeout=30,
+    batch_size=None,
+    logprobs=False,
+    temperature=TEMPERATURE,
+    max_tokens=None,
+    response_format=JSON_RESPONSE_FORMAT,
 ):
+    """This function completes all prompts concurrently through the global scheduler.
+
+    Results are returned in the order of `prompts`, with None for requests that failed.
+    Large calls go to the bulk-job backend if one is set with `configure_backend`.
+    `batch_size` is accepted for backwards compatibility but no longer used; throughput
+    is set globally with `configure_throughput`.
+    """
+    if batch_runner is not None and len(prompts) >= batch_min_requests:
+        responses = complete_openai_request_batch(
+            prompts,
+            model,
+            logprobs=logprobs,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            response_format=response_format,
+        )
+        cache.log_stats()
+        return responses
+    responses = get_client().run(
+        acomplete_many(
+            prompts,
+            model=model,
+            timeout=timeout,
+            temperature=temperature,
+            logprobs=logprobs,
+            max_tokens=max_tokens,
+            response_format=response_format,
+        )
+    )
+    cache.log_stats()
+    return responses
 
-    async def parralel_openai_request(prompts, model, timeout, batch_size):
-        async with aiohttp.ClientSession() as session:
-            if logprobs:
-                  tasks = [
-                     complete_openai_request_http_logprobs(session, prompt, model, timeout)
-                     for prompt in prompts
-                  ]
-            else:
-                  tasks = [
-                complete_openai_request_http(session, prompt, model, timeout)
-                for prompt in prompts
-            ]
-            all_objects = []
-            # gather preserves the order of the tasks
-            for i in range(0, len(tasks), batch_size):
-                responses = await asyncio.gather(
-                    *tasks[i : i + batch_size], return_exceptions=True
-                )
-                for response in responses:
-                    if isinstance(response, Exception):
-                        # return None if there was an error
-                        all_objects.append(None)
-                    else:
-                        all_objects.append(response)
-                await asyncio.sleep(5)
-
-            return all_objects
-
-    responses = asyncio.run(
-        parralel_openai_request(prompts, model, timeout, batch_size)
+
+def batch_classification_chunks(documents, max_tokens, max_documents, model):
+    """This function groups document indices into consecutive batches under a token and document budget."""
+    document_tokens = estimate_tokens(documents, model, completion_tokens=0)
+    batches = [[]]
+    current_num_tokens = 0
+    for index, tokens in enumerate(document_tokens):
+        if batches[-1] and (
+            current_num_tokens + tokens > max_tokens or len(batches[-1]) >= max_documents
+        ):
+            batches.append([])
+            current_num_tokens = 0
+        batches[-1].append(index)
+        current_num_tokens += tokens
+    return [batch for batch in batches if batch]
+
+
+def classify_documents_batched(
+    documents, topic_list, model, max_tokens=8_000, max_documents=20, timeout=60
+):
+    """This function classifies documents with several documents per request.
+
+    The result has one entry per document in the same format as the single-document
+    classification, {"topic": idx} or None, so it can be passed to `assign_topic` unchanged.
+    Documents that are missing from a batched answer, or whose entry is unusable, are
+    classified again with one request each.
+    """
+    batches = batch_classification_chunks(documents, max_tokens, max_documents, model)
+    prompts = [
+        topic_classification_batch_prompt(
+            [(index, documents[index]) for index in batch], topic_list
+        )
+        for batch in batches
+    ]
+    responses = complete_openai_request_parralel(prompts, model=model, timeout=timeout)
+
+    results = [None] * len(documents)
+    for batch, response in zip(batches, responses):
+        if not isinstance(response, dict) or not isinstance(
+            response.get("classifications"), list
+        ):
+            continue
+        batch_ids = set(batch)
+        for entry in response["classifications"]:
+            if not isinstance(entry, dict):
+                continue
+            doc_id, topic = entry.get("doc_id"), entry.get("topic")
+            if doc_id in batch_ids and isinstance(topic, int) and 0 <= topic < len(topic_list):
+                results[doc_id] = {"topic": topic}
+
+    missing = [index for index, result in enumerate(results) if result is None]
+    if missing:
+        print(f"Re-classifying {len(missing)} documents missing from batched responses")
+        prompts = [topic_classification_prompt(documents[index], topic_list) for index in missing]
+        responses = complete_openai_request_parralel(prompts, model=model, timeout=30)
+        for index, response in zip(missing, responses):
+            results[index] = response
+    return results
+
+
+def topic_distribution_from_logprobs(response, n_topics):
+    """This function turns the top logprobs of the first answer token into a probability vector over topics.
+
+    Tokens that are not a valid topic index are dropped and the remaining mass is
+    renormalized. Returns None if no valid index is among the top tokens. Indices below
+    1000 are single tokens in the OpenAI encodings, so one token suffices.
+    """
+    try:
+        top_logprobs = response["choices"][0]["logprobs"]["content"][0]["top_logprobs"]
+    except (KeyError, IndexError, TypeError):
+        return None
+    probabilities = np.zeros(n_topics, dtype=np.float32)
+    for entry in top_logprobs:
+        token = entry["token"].strip()
+        # isdigit() also accepts e.g. "²", which int() rejects
+        if token.isascii() and token.isdecimal() and int(token) < n_topics:
+            probabilities[int(token)] += math.exp(entry["logprob"])
+    total = probabilities.sum()
+    if total <= 0:
+        return None
+    return probabilities / total
+
+
+def classify_documents_logprobs(documents, topic_list, model, max_tokens=2, timeout=30):
+    """This function classifies each document with a single answer token and reads its top logprobs.
+
+    Each result is {"topic": idx, "probabilities": vector over topics}, or None if the
+    answer contained no valid index, so it can be passed to `assign_topic` unchanged.
+    """
+    prompts = [topic_classification_index_prompt(document, topic_list) for document in documents]
+    responses = complete_openai_request_parralel(
+        prompts,
+        model=model,
+        timeout=timeout,
+        logprobs=True,
+        max_tokens=max_tokens,
+        response_format=None,
     )
-    return responses
\ No newline at end of file
+    results = []
+    for response in responses:
+        probabilities = topic_distribution_from_logprobs(response, len(topic_list))
+        if probabilities is None:
+            results.append(None)
+        else:
+            results.append({"topic": int(probabilities.argmax()), "probabilities": probabilities})
+    return results
+
+
+def topic_probabilities(results, topic_assignments, n_topics):
+    """This function returns the (n_docs, n_topics) float32 matrix of soft topic assignments.
+
+    Rows come from the logprob distributions where available and agree with the final
+    assignment; other documents get a one-hot row, or zeros if they are unclassified.
+    """
+    matrix = np.zeros((len(topic_assignments), n_topics), dtype=np.float32)
+    for i, (result, topic) in enumerate(zip(results, topic_assignments)):
+        probabilities = result.get("probabilities") if isinstance(result, dict) else None
+        if probabilities is not None:
+            # results loaded from a checkpoint hold lists
+            probabilities = np.asarray(probabilities, dtype=np.float32)
+        if probabilities is not None and len(probabilities) == n_topics and probabilities.argmax() == topic:
+            matrix[i] = probabilities
+        elif topic >= 0:
+            matrix[i, topic] = 1.0
+    return matrix
+
+
+def classify_documents(documents, topic_list, model, config):
+    """This function classifies documents with the CLASSIFICATION_MODE of `config`.
+
+    "single" sends one request per document, "batched" packs several documents per
+    request, "logprobs" asks for a single index token and keeps its probabilities, and
+    "embedding" assigns documents by cosine similarity to the topic names without any
+    chat completions. Every mode returns one {"topic": idx} (or None) per document, the
+    format `assign_topic` expects.
+    """
+    mode = config.get("CLASSIFICATION_MODE", "single")
+    if mode == "batched":
+        return classify_documents_batched(
+            documents,
+            topic_list,
+            model,
+            max_tokens=config.get("CLASSIFICATION_BATCH_TOKENS", 8_000),
+            max_documents=config.get("CLASSIFICATION_BATCH_SIZE", 20),
+        )
+    if mode == "logprobs":
+        return classify_documents_logprobs(
+            documents,
+            topic_list,
+            model,
+            max_tokens=config.get("LOGPROB_MAX_TOKENS", 2),
+        )
+    if mode == "embedding":
+        from embedding_classifier import classify_by_embedding, get_embedding_provider
+
+        assignments = classify_by_embedding(
+            documents, topic_list, get_embedding_provider(config)
+        )
+        return [{"topic": int(topic)} for topic in assignments]
+    if mode != "single":
+        raise ValueError(f"Unknown classification mode {mode}")
+    prompts = [topic_classification_prompt(document, topic_list) for document in documents]
+    return complete_openai_request_parralel(prompts, model=model, timeout=30)
+
+
+# why `assign_topic` rejected a classification
+FAILURE_REASONS = {-3: "no_response", -2: "missing_topic_key", -1: "topic_out_of_range"}
+
+
+def repair_classifications(
+    documents,
+    topic_list,
+    topic_assignments,
+    assign_topic,
+    model,
+    max_attempts=3,
+    temperatures=(0.3, 0.7, 1.0),
+):
+    """This function classifies every failed document again, all of them concurrently per attempt.
+
+    A document failed if `assign_topic` gave it a negative value. Each attempt uses the
+    stricter repair prompt and the next temperature of `temperatures`. It returns the
+    repaired assignments and a log with one entry per failed document and attempt,
+    recording why its answer was rejected.
+    """
+    topic_assignments = list(topic_assignments)
+    repair_log = []
+    for attempt in range(max_attempts):
+        failed = [i for i, topic in enumerate(topic_assignments) if topic < 0]
+        if not failed:
+            break
+        repair_log.extend(
+            {
+                "document": i,
+                "attempt": attempt,
+                "reason": FAILURE_REASONS.get(topic_assignments[i], "unknown"),
+            }
+            for i in failed
+        )
+        temperature = temperatures[min(attempt, len(temperatures) - 1)]
+        print(f"Repairing {len(failed)} classifications, attempt {attempt + 1} at temperature {temperature}")
+        prompts = [topic_classification_repair_prompt(documents[i], topic_list) for i in failed]
+        results = complete_openai_request_parralel(
+            prompts, model=model, timeout=30, temperature=temperature
+        )
+        for i, result in zip(failed, results):
+            topic_assignments[i] = assign_topic(result)
+
+    n_unresolved = sum(topic < 0 for topic in topic_assignments)
+    if n_unresolved:
+        print(f"{n_unresolved} documents are still unclassified after {max_attempts} repair attempts")
+    return topic_assignments, repair_log
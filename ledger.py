@@ -0,0 +1,127 @@
+import contextvars
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+from phases import current_phase
+
+# USD per million tokens: (prompt, cached prompt, completion)
+PRICES_PER_MILLION = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4-turbo": (10.00, 10.00, 30.00),
+    "gpt-3.5-turbo": (0.50, 0.50, 1.50),
+    "text-embedding-3-small": (0.02, 0.02, 0.0),
+    "text-embedding-3-large": (0.13, 0.13, 0.0),
+}
+
+# requests sent through the batch endpoint cost half
+BATCH_DISCOUNT = 0.5
+BATCH_SUFFIX = " (batch)"
+
+_current_ledger = contextvars.ContextVar("ledger", default=None)
+
+
+def batch_model_name(model):
+    """Return the name under which requests of `model` sent as a bulk job are recorded."""
+    return f"{model}{BATCH_SUFFIX}"
+
+
+def model_prices(model):
+    """Return the prices of `model`, matching dated snapshots such as gpt-4o-2024-08-06 by prefix."""
+    discount = 1.0
+    if model.endswith(BATCH_SUFFIX):
+        model = model[: -len(BATCH_SUFFIX)]
+        discount = BATCH_DISCOUNT
+    for name in sorted(PRICES_PER_MILLION, key=len, reverse=True):
+        if model.startswith(name):
+            return tuple(price * discount for price in PRICES_PER_MILLION[name])
+    return None
+
+
+class RunLedger:
+    """Counts the requests, tokens, latency and cost of one run, per phase and model."""
+
+    FIELDS = [
+        "requests",
+        "cache_hits",
+        "retries",
+        "prompt_tokens",
+        "cached_tokens",
+        "completion_tokens",
+        "latency_seconds",
+    ]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.entries = {}
+
+    def _entry(self, phase_name, model):
+        key = (phase_name or "unattributed", model)
+        if key not in self.entries:
+            self.entries[key] = {**{field: 0 for field in self.FIELDS}, "statuses": Counter()}
+        return self.entries[key]
+
+    def record(self, model, status, latency=0.0, usage=None, cache_hit=False):
+        """Record one attempt; failed attempts (status other than 200) count as retries."""
+        usage = usage or {}
+        details = usage.get("prompt_tokens_details") or {}
+        with self._lock:
+            entry = self._entry(current_phase(), model)
+            if cache_hit:
+                entry["cache_hits"] += 1
+                return
+            entry["requests"] += 1
+            entry["statuses"][str(status)] += 1
+            entry["latency_seconds"] += latency
+            if status != 200:
+                entry["retries"] += 1
+            entry["prompt_tokens"] += usage.get("prompt_tokens", 0)
+            entry["cached_tokens"] += details.get("cached_tokens") or 0
+            entry["completion_tokens"] += usage.get("completion_tokens", 0)
+
+    def rows(self):
+        """Return one dict per phase and model, including the cost in USD (None for unknown models)."""
+        with self._lock:
+            entries = [(key, dict(entry)) for key, entry in self.entries.items()]
+        rows = []
+        for (phase_name, model), entry in entries:
+            prices = model_prices(model)
+            cost = None
+            if prices is not None:
+                uncached = entry["prompt_tokens"] - entry["cached_tokens"]
+                cost = (
+                    uncached * prices[0]
+                    + entry["cached_tokens"] * prices[1]
+                    + entry["completion_tokens"] * prices[2]
+                ) / 1e6
+            statuses = " ".join(f"{status}:{n}" for status, n in sorted(entry.pop("statuses").items()))
+            rows.append(
+                {"phase": phase_name, "model": model, **entry, "statuses": statuses, "cost_usd": cost}
+            )
+        return rows
+
+    def totals(self):
+        rows = self.rows()
+        return {
+            "cost_usd": sum(row["cost_usd"] or 0.0 for row in rows),
+            "total_tokens": sum(row["prompt_tokens"] + row["completion_tokens"] for row in rows),
+            "requests": sum(row["requests"] for row in rows),
+        }
+
+
+@contextmanager
+def use_ledger(ledger):
+    """Record the LLM calls made in the enclosed block, including those of its async tasks, in `ledger`."""
+    token = _current_ledger.set(ledger)
+    try:
+        yield ledger
+    finally:
+        _current_ledger.reset(token)
+
+
+def record_request(model, status, latency=0.0, usage=None, cache_hit=False):
+    """Record one attempt in the current ledger; does nothing outside `use_ledger`."""
+    ledger = _current_ledger.get()
+    if ledger is not None:
+        ledger.record(model, status, latency=latency, usage=usage, cache_hit=cache_hit)
@@ -0,0 +1,138 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from Auxiliary import logger
+
+
+def make_cache_key(model, messages, temperature, response_format=None, **kwargs):
+    """This function returns a stable hash for every setting that influences a completion."""
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "response_format": response_format,
+    }
+    payload.update(kwargs)
+    serialized = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """On-disk cache for LLM completions, stored in a single SQLite file.
+
+    The connection is shared between threads and guarded by a lock, so it can be
+    used from coroutines running on any event loop. Entries older than `max_age`
+    seconds are ignored and pruned, and the least recently used entries are
+    evicted once the table holds more than `max_entries` rows.
+    """
+
+    def __init__(self, path, max_entries=1_000_000, max_age=None, enabled=True):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS completions_accessed ON completions (accessed)"
+            )
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute(
+                "SELECT value, created FROM completions WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.max_age is not None and now - row[1] > self.max_age):
+                self.misses += 1
+                return None
+            connection.execute(
+                "UPDATE completions SET accessed = ? WHERE key = ?", (now, key)
+            )
+            connection.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        now = time.time()
+        serialized = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            connection = self._connect()
+            connection.execute(
+                "INSERT OR REPLACE INTO completions (key, value, created, accessed) "
+                "VALUES (?, ?, ?, ?)",
+                (key, serialized, now, now),
+            )
+            connection.commit()
+            self.writes += 1
+            if self.writes % 1_000 == 0:
+                self._evict(connection, now)
+
+    def evict(self):
+        """Remove expired entries and trim the cache down to `max_entries`."""
+        with self._lock:
+            self._evict(self._connect(), time.time())
+
+    def _evict(self, connection, now):
+        if self.max_age is not None:
+            connection.execute(
+                "DELETE FROM completions WHERE created < ?", (now - self.max_age,)
+            )
+        if self.max_entries is not None:
+            connection.execute(
+                "DELETE FROM completions WHERE key IN ("
+                "SELECT key FROM completions ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+        connection.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info(
+            f"LLM cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"({stats['hit_rate']:.1%} hit rate), {stats['writes']} writes"
+        )
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
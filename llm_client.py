@@ -0,0 +1,129 @@
+import asyncio
+import atexit
+import contextvars
+import threading
+from contextlib import contextmanager
+
+
+class LLMClient:
+    """One aiohttp session with a keep-alive connection pool, served by an event loop on a background thread.
+
+    Coroutines that use `session` must run on this client's loop; synchronous code
+    submits them with `run`, which blocks until the result is available. The loop
+    and the pool live until `close` is called, so TCP and TLS connections are reused
+    by every phase of a run instead of being set up again for each batch.
+    """
+
+    def __init__(self, limit=100, limit_per_host=0, ttl_dns_cache=300, keepalive_timeout=60):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+        self.session = None
+        self._loop = None
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            limit=config.get("HTTP_POOL_LIMIT", 100),
+            limit_per_host=config.get("HTTP_POOL_LIMIT_PER_HOST", 0),
+            ttl_dns_cache=config.get("DNS_CACHE_TTL", 300),
+        )
+
+    def start(self):
+        import aiohttp
+
+        started = threading.Event()
+
+        async def open_session():
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.ttl_dns_cache,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+
+        def serve():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(open_session())
+            started.set()
+            self._loop.run_forever()
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=serve, name="llm-client", daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    @property
+    def running(self):
+        return self._loop is not None
+
+    def run(self, coroutine):
+        """Run `coroutine` on the client's loop and wait for its result.
+
+        The caller's context variables, such as its phase and ledger, are carried over
+        so that the calls are attributed to the caller.
+        """
+        context = contextvars.copy_context()
+
+        async def in_context():
+            # a task runs in a copy of the loop's context, so these sets stay local to it
+            for variable, value in context.items():
+                variable.set(value)
+            return await coroutine
+
+        return asyncio.run_coroutine_threadsafe(in_context(), self._loop).result()
+
+    def close(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.session.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+        self.session = None
+
+
+_client = None
+_client_config = None
+_scope_depth = 0
+_client_lock = threading.Lock()
+
+
+def get_client(config=None):
+    """Return the shared client, starting one on first use."""
+    global _client
+    with _client_lock:
+        if _client is None or not _client.running:
+            config = config or _client_config
+            _client = (LLMClient.from_config(config) if config else LLMClient()).start()
+            atexit.register(_client.close)
+        return _client
+
+
+@contextmanager
+def client_scope(config=None):
+    """Keep the shared client alive for the enclosed block, e.g. a whole run or grid.
+
+    The client is started lazily by the first request, so models that never call the
+    API do not open a pool. When the outermost scope ends the client is closed.
+    """
+    global _client, _client_config, _scope_depth
+    with _client_lock:
+        _scope_depth += 1
+        if _scope_depth == 1:
+            _client_config = config
+    try:
+        yield
+    finally:
+        with _client_lock:
+            _scope_depth -= 1
+            if _scope_depth == 0:
+                if _client is not None:
+                    _client.close()
+                    _client = None
+                _client_config = None
@@ -0,0 +1,17 @@
+import importlib
+
+# model name -> module defining the class of that name; a module, and with it its
+# backend (bertopic, gensim, openai, ...), is only imported once its model is selected
+MODELS = {
+    "GenAIMethod": "GenAIMethod",
+    "GenAIMethodOneShot": "GenAIMethodOneShot",
+    "GenAIMethodOneShotNoPrior": "GenAIMethodOneShotNoPrior",
+    "BERTopicModel": "BERTopicModel",
+    "LDAGensimModel": "LDAGensimModel",
+    "NMFModel": "NMFModel",
+}
+
+
+def load_model_class(class_name):
+    # models that are not registered live in a module with the same name as their class
+    return getattr(importlib.import_module(MODELS.get(class_name, class_name)), class_name)
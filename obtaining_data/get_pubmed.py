@@ -1,79 +1,250 @@
-import requests
+import argparse
+import asyncio
+import json
+import os
+import time
 from xml.etree import ElementTree as ET
+
+import aiohttp
 import pandas as pd
 
+BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
+COLUMNS = ["title", "abstract", "authors", "pub_date", "mesh_subheading"]
 
-def get_pmids(mesh_subheading, start_date, end_date, max_results=100):
-    base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
-    search_url = (
-        f"{base_url}esearch.fcgi?db=pubmed&term={mesh_subheading}[sh]"
-        f"&datetype=pdat&mindate={start_date}&maxdate={end_date}"
-        f"&sort=relevance&retmax={max_results}&retmode=json"
-    )
-    response = requests.get(search_url)
-    search_results = response.json()
-    return search_results['esearchresult']['idlist']
-
-def fetch_article_details(pmids):
-    base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
-    pmid_list = ','.join(pmids)
-    fetch_url = f"{base_url}efetch.fcgi?db=pubmed&id={pmid_list}&retmode=xml"
-    print(fetch_url)
-    response = requests.get(fetch_url)
-    root = ET.fromstring(response.content)
-    articles = []
-    for article in root.findall('.//PubmedArticle'):
-        details = {}
-        
-        # Extract title
-        title = article.find('.//ArticleTitle')
-        details['title'] = title.text if title is not None else None
-        
-        # Extract abstract
-        abstract = article.find('.//AbstractText')
-        details['abstract'] = abstract.text if abstract is not None else None
-        
-        # Extract authors
-        authors = article.findall('.//Author')
-        author_list = []
-        for author in authors:
-            last_name = author.find('LastName')
-            fore_name = author.find('ForeName')
-            if last_name is not None and fore_name is not None:
-                author_list.append(f"{fore_name.text} {last_name.text}")
-        details['authors'] = ", ".join(author_list) if author_list else None
-        
-        # Extract publication date
-        pub_date = article.find('.//PubDate')
-        if pub_date is not None:
-            year = pub_date.find('Year')
-            month = pub_date.find('Month')
-            day = pub_date.find('Day')
-            if year is not None and month is not None and day is not None:
-                details['pub_date'] = f"{year.text}-{month.text}-{day.text}"
-            elif year is not None and month is not None:
-                details['pub_date'] = f"{year.text}-{month.text}"
-            elif year is not None:
-                details['pub_date'] = year.text
-            else:
-                details['pub_date'] = None
+
+class RateLimiter:
+    """Spaces the start of requests at least 1 / requests_per_second seconds apart."""
+
+    def __init__(self, requests_per_second):
+        self.interval = 1.0 / requests_per_second
+        self.next_time = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def article_details(article):
+    details = {}
+    
+    # Extract title
+    title = article.find('.//ArticleTitle')
+    details['title'] = title.text if title is not None else None
+    
+    # Extract abstract
+    abstract = article.find('.//AbstractText')
+    details['abstract'] = abstract.text if abstract is not None else None
+    
+    # Extract authors
+    authors = article.findall('.//Author')
+    author_list = []
+    for author in authors:
+        last_name = author.find('LastName')
+        fore_name = author.find('ForeName')
+        if last_name is not None and fore_name is not None:
+            author_list.append(f"{fore_name.text} {last_name.text}")
+    details['authors'] = ", ".join(author_list) if author_list else None
+    
+    # Extract publication date
+    pub_date = article.find('.//PubDate')
+    if pub_date is not None:
+        year = pub_date.find('Year')
+        month = pub_date.find('Month')
+        day = pub_date.find('Day')
+        if year is not None and month is not None and day is not None:
+            details['pub_date'] = f"{year.text}-{month.text}-{day.text}"
+        elif year is not None and month is not None:
+            details['pub_date'] = f"{year.text}-{month.text}"
+        elif year is not None:
+            details['pub_date'] = year.text
         else:
             details['pub_date'] = None
-        
-        # Only include articles with non-None abstract and publication date
-        if details['abstract'] is not None and details['pub_date'] is not None:
-            articles.append(details)
-    return articles
-
-def get_popular_abstracts(mesh_subheadings, start_date="2024/01/01", end_date="2025/12/31"):
-    all_articles = []
-    for subheading in mesh_subheadings:
-        pmids = get_pmids(subheading, start_date, end_date)
-        articles = fetch_article_details(pmids)
+    else:
+        details['pub_date'] = None
+    return details
+
+
+class PubmedFetcher:
+    """Fetches the most relevant abstracts per MeSH subheading from the NCBI E-utilities.
+
+    All requests share one aiohttp session and a rate limit of `requests_per_second`
+    (NCBI allows 3 per second, or 10 with an API key). `base_url` can point at a
+    local stand-in server for testing.
+    """
+
+    def __init__(self, base_url=BASE_URL, api_key=None, requests_per_second=None, max_retries=5, timeout=60):
+        self.base_url = base_url.rstrip("/") + "/"
+        self.api_key = api_key
+        self.limiter = RateLimiter(requests_per_second or (10 if api_key else 3))
+        self.max_retries = max_retries
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+
+    def params(self, **params):
+        if self.api_key:
+            params["api_key"] = self.api_key
+        return params
+
+    async def request(self, session, endpoint, params, handle):
+        """Send a GET request, retrying 429s, server errors and dropped connections, and return `handle(response)`."""
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.wait()
+            try:
+                async with session.get(
+                    self.base_url + endpoint, params=params, timeout=self.timeout
+                ) as response:
+                    if response.status == 200:
+                        return await handle(response)
+                    if response.status != 429 and response.status < 500:
+                        response.raise_for_status()
+                    error = f"status {response.status}"
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError) as e:
+                error = repr(e)
+            if attempt < self.max_retries:
+                print(f"{endpoint} failed ({error}), retrying")
+                await asyncio.sleep(2**attempt)
+        raise RuntimeError(f"{endpoint} failed {self.max_retries + 1} times, last error {error}")
+
+    async def get_pmids(self, session, mesh_subheading, start_date, end_date, max_results=100):
+        params = self.params(
+            db="pubmed",
+            term=f"{mesh_subheading}[sh]",
+            datetype="pdat",
+            mindate=start_date,
+            maxdate=end_date,
+            sort="relevance",
+            retmax=max_results,
+            retmode="json",
+        )
+
+        async def handle(response):
+            return (await response.json(content_type=None))["esearchresult"]["idlist"]
+
+        return await self.request(session, "esearch.fcgi", params, handle)
+
+    async def fetch_article_details(self, session, pmids):
+        """Parse the efetch XML while it streams in, keeping only the extracted fields of each article."""
+        if not pmids:
+            return []
+        params = self.params(db="pubmed", id=",".join(pmids), retmode="xml")
+
+        async def handle(response):
+            parser = ET.XMLPullParser(events=("end",))
+            articles = []
+            async for block in response.content.iter_chunked(1 << 16):
+                parser.feed(block)
+                for _, element in parser.read_events():
+                    if element.tag == "PubmedArticle":
+                        details = article_details(element)
+                        # Only include articles with non-None abstract and publication date
+                        if details['abstract'] is not None and details['pub_date'] is not None:
+                            articles.append(details)
+                        element.clear()
+            parser.close()
+            return articles
+
+        return await self.request(session, "efetch.fcgi", params, handle)
+
+    async def fetch_subheading(self, session, subheading, start_date, end_date, max_results=100):
+        pmids = await self.get_pmids(session, subheading, start_date, end_date, max_results)
+        articles = await self.fetch_article_details(session, pmids)
         for article in articles:
             article['mesh_subheading'] = subheading
-        all_articles.extend(articles)
-    return all_articles
+        return articles
+
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return []
+    with open(manifest_path, encoding="utf-8") as f:
+        return json.load(f)["completed"]
+
+
+def save_manifest(manifest_path, completed):
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"completed": completed}, f, indent=1)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def drop_unfinished_rows(csv_file_path, completed):
+    """Remove rows of subheadings that were written but not recorded as completed before a crash."""
+    if not os.path.exists(csv_file_path):
+        return
+    df = pd.read_csv(csv_file_path)
+    finished = df["mesh_subheading"].isin(completed)
+    if not finished.all():
+        df[finished].to_csv(csv_file_path, index=False)
+
+
+def finish_download(partial_path, csv_file_path, mesh_subheadings):
+    """Replace `csv_file_path` with the downloaded rows, ordered by subheading as in `mesh_subheadings`."""
+    df = pd.read_csv(partial_path, keep_default_na=False)
+    order = {subheading: i for i, subheading in enumerate(mesh_subheadings)}
+    df = df.sort_values("mesh_subheading", key=lambda column: column.map(order), kind="stable")
+    df.to_csv(partial_path, index=False)
+    os.replace(partial_path, csv_file_path)
+
+
+async def get_popular_abstracts(
+    mesh_subheadings,
+    csv_file_path,
+    manifest_path=None,
+    start_date="2024/01/01",
+    end_date="2025/12/31",
+    max_results=100,
+    fetcher=None,
+):
+    """Fetch all subheadings concurrently and write them to `csv_file_path`.
+
+    The rows of each subheading are appended to `csv_file_path + ".partial"` as soon as
+    it completes, and the completed subheadings are recorded in a JSON manifest, so a
+    restarted run only fetches the remaining ones. `csv_file_path` is only replaced
+    once every subheading has been fetched.
+    """
+    fetcher = fetcher or PubmedFetcher()
+    partial_path = csv_file_path + ".partial"
+    manifest_path = manifest_path or csv_file_path + ".manifest.json"
+    completed = load_manifest(manifest_path) if os.path.exists(partial_path) else []
+    drop_unfinished_rows(partial_path, completed)
+    pending = [subheading for subheading in mesh_subheadings if subheading not in completed]
+    print(f"{len(completed)} subheadings already fetched, {len(pending)} to go")
+
+    failed = []
+    async with aiohttp.ClientSession() as session:
+
+        async def fetch(subheading):
+            try:
+                return subheading, await fetcher.fetch_subheading(
+                    session, subheading, start_date, end_date, max_results
+                )
+            except Exception as e:
+                return subheading, e
+
+        for task in asyncio.as_completed([fetch(subheading) for subheading in pending]):
+            subheading, articles = await task
+            if isinstance(articles, Exception):
+                print(f"Failed to fetch {subheading}: {articles!r}")
+                failed.append(subheading)
+                continue
+            pd.DataFrame(articles, columns=COLUMNS).to_csv(
+                partial_path,
+                mode="a",
+                header=not os.path.exists(partial_path),
+                index=False,
+            )
+            completed.append(subheading)
+            save_manifest(manifest_path, completed)
+            print(f"{subheading}: {len(articles)} articles ({len(completed)}/{len(mesh_subheadings)})")
+    if not failed:
+        if os.path.exists(partial_path):
+            finish_download(partial_path, csv_file_path, mesh_subheadings)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+    return failed
 
 # List of MeSH subheadings
 mesh_subheadings = ['AB',
@@ -153,12 +324,34 @@ mesh_subheadings = ['AB',
  'IN',
  'VI']
 
-# Retrieve popular abstracts for each MeSH subheading
-popular_articles = get_popular_abstracts(mesh_subheadings)
 
-# Create a DataFrame from the list of articles
-df = pd.DataFrame(popular_articles)
+def main():
+    parser = argparse.ArgumentParser(description="Download PubMed abstracts for every MeSH subheading.")
+    parser.add_argument("--output", default="data_in/pubmed_articles.csv")
+    parser.add_argument("--manifest", help="completed subheadings (default: OUTPUT.manifest.json)")
+    parser.add_argument("--api-key", default=os.getenv("NCBI_API_KEY"))
+    parser.add_argument("--requests-per-second", type=float, help="default 3, or 10 with an API key")
+    parser.add_argument("--base-url", default=BASE_URL)
+    parser.add_argument("--start-date", default="2024/01/01")
+    parser.add_argument("--end-date", default="2025/12/31")
+    parser.add_argument("--max-results", type=int, default=100)
+    args = parser.parse_args()
+
+    fetcher = PubmedFetcher(args.base_url, args.api_key, args.requests_per_second)
+    failed = asyncio.run(
+        get_popular_abstracts(
+            mesh_subheadings,
+            args.output,
+            manifest_path=args.manifest,
+            start_date=args.start_date,
+            end_date=args.end_date,
+            max_results=args.max_results,
+            fetcher=fetcher,
+        )
+    )
+    if failed:
+        print(f"{len(failed)} subheadings failed, run again to retry them: {failed}")
+
 
-# Save the DataFrame to a CSV file
-csv_file_path = 'data_in/pubmed_articles.csv'
-df.to_csv(csv_file_path, index=False)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+_current_phase = contextvars.ContextVar("phase", default=None)
+
+
+class PhaseRecorder:
+    """Collects the wall time spent in each named pipeline phase."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.phases = {}
+
+    def add(self, name, seconds):
+        with self._lock:
+            entry = self.phases.setdefault(name, {"seconds": 0.0, "calls": 0})
+            entry["seconds"] += seconds
+            entry["calls"] += 1
+
+    def reset(self):
+        with self._lock:
+            self.phases = {}
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(entry) for name, entry in self.phases.items()}
+
+
+recorder = PhaseRecorder()
+
+
+@contextmanager
+def phase(name):
+    """Time the enclosed block as phase `name`; LLM calls made inside it are attributed to it."""
+    token = _current_phase.set(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add(name, time.perf_counter() - start)
+        _current_phase.reset(token)
+
+
+def current_phase():
+    return _current_phase.get()
@@ -0,0 +1,210 @@
+import asyncio
+import random
+import threading
+import time
+
+from Auxiliary import logger
+
+
+class APIStatusError(Exception):
+    """Raised for a non-200 response; carries the status and the server's Retry-After hint."""
+
+    def __init__(self, status, message="", retry_after=None):
+        super().__init__(f"HTTP {status}: {message[:200]}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(headers):
+    """This function reads the wait time in seconds from Retry-After style headers."""
+    for name in ("retry-after-ms", "Retry-After-Ms"):
+        if name in headers:
+            try:
+                return float(headers[name]) / 1_000
+            except ValueError:
+                pass
+    for name in ("retry-after", "Retry-After"):
+        if name in headers:
+            try:
+                return float(headers[name])
+            except ValueError:
+                return None
+    return None
+
+
+class TokenBucket:
+    """A thread-safe token bucket that refills `capacity` units every minute."""
+
+    def __init__(self, capacity):
+        self.capacity = float(capacity)
+        self.available = float(capacity)
+        self.rate = self.capacity / 60
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.available = min(
+            self.capacity, self.available + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def try_acquire(self, amount):
+        """Take `amount` units if available; otherwise return the seconds to wait."""
+        # a single request larger than the whole budget is let through once the bucket is full
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.available >= amount:
+                self.available -= amount
+                return 0.0
+            return (amount - self.available) / self.rate
+
+    async def acquire(self, amount):
+        while True:
+            wait = self.try_acquire(amount)
+            if wait <= 0:
+                return
+            await asyncio.sleep(min(wait, 1.0))
+
+
+class RequestScheduler:
+    """Runs requests through a sliding window of concurrent slots under rate budgets.
+
+    Concurrency is adapted with AIMD: every successful request grows the window
+    by 1/window (so roughly one slot per window of successes) and every rate
+    limit or server error halves it. A 429 also pauses new requests for the
+    duration given by its Retry-After header. The scheduler only uses
+    thread-safe state, so one instance can be shared by several event loops.
+    """
+
+    RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        max_concurrency=50,
+        min_concurrency=1,
+        requests_per_minute=None,
+        tokens_per_minute=None,
+        max_retries=30,
+        backoff=5,
+    ):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(max_concurrency)
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.n_requests = 0
+        self.n_errors = 0
+        self.n_rate_limited = 0
+        self._lock = threading.Lock()
+
+    async def _acquire_slot(self):
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                wait = self.paused_until - now
+                if wait <= 0 and self.in_flight < int(self.concurrency):
+                    self.in_flight += 1
+                    return
+            await asyncio.sleep(min(max(wait, 0.02), 1.0))
+
+    def _release_slot(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _on_success(self):
+        with self._lock:
+            self.n_requests += 1
+            self.concurrency = min(
+                self.max_concurrency, self.concurrency + 1 / self.concurrency
+            )
+
+    def _on_error(self, rate_limited=False, retry_after=None):
+        with self._lock:
+            self.n_errors += 1
+            self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+            if rate_limited:
+                self.n_rate_limited += 1
+                if retry_after is not None:
+                    self.paused_until = max(
+                        self.paused_until, time.monotonic() + retry_after
+                    )
+
+    async def run(self, request_factory, estimated_tokens=0, retry_invalid=True):
+        """Await `request_factory()` with retries; the factory must create a fresh coroutine per call.
+
+        With retry_invalid=False only HTTP and transport errors are retried, and any other
+        exception (e.g. an unparsable answer) is raised to the caller right away.
+        """
+        for attempt in range(self.max_retries):
+            if self.request_bucket is not None:
+                await self.request_bucket.acquire(1)
+            if self.token_bucket is not None:
+                await self.token_bucket.acquire(estimated_tokens)
+            await self._acquire_slot()
+            try:
+                result = await request_factory()
+            except APIStatusError as e:
+                self._release_slot()
+                if e.status not in self.RETRYABLE_STATUSES:
+                    raise
+                self._on_error(rate_limited=e.status == 429, retry_after=e.retry_after)
+                wait = e.retry_after if e.retry_after is not None else self._backoff(attempt)
+                logger.error(f"Error: {e}. Retrying in {wait:.1f} seconds")
+                await asyncio.sleep(wait)
+            except (asyncio.TimeoutError, OSError) as e:
+                self._release_slot()
+                self._on_error()
+                wait = self._backoff(attempt)
+                logger.error(f"Error: {e!r}. Retrying in {wait:.1f} seconds")
+                await asyncio.sleep(wait)
+            except Exception as e:
+                # e.g. a malformed JSON answer; retry without shrinking the window
+                self._release_slot()
+                if not retry_invalid:
+                    raise
+                wait = self._backoff(attempt)
+                logger.error(f"Error: {e!r}. Retrying in {wait:.1f} seconds")
+                await asyncio.sleep(wait)
+            else:
+                self._release_slot()
+                self._on_success()
+                return result
+        raise RuntimeError(f"Request failed after {self.max_retries} attempts")
+
+    def _backoff(self, attempt):
+        return min(self.backoff * 2 ** min(attempt, 4), 60) * random.uniform(0.5, 1.0)
+
+    async def map(self, request_factories, estimated_tokens=None):
+        """Run all requests concurrently and return their results in input order, with None for failures."""
+        if estimated_tokens is None:
+            estimated_tokens = [0] * len(request_factories)
+        results = [None] * len(request_factories)
+        queue = asyncio.Queue()
+        for item in enumerate(zip(request_factories, estimated_tokens)):
+            queue.put_nowait(item)
+
+        # at most max_concurrency workers wait on the window, instead of one coroutine per request
+        async def worker():
+            while not queue.empty():
+                index, (factory, tokens) = queue.get_nowait()
+                try:
+                    results[index] = await self.run(factory, tokens)
+                except Exception as e:
+                    logger.error(f"Giving up on request: {e!r}")
+
+        n_workers = min(self.max_concurrency, len(request_factories))
+        await asyncio.gather(*[worker() for _ in range(n_workers)])
+        return results
+
+    def stats(self):
+        return {
+            "requests": self.n_requests,
+            "errors": self.n_errors,
+            "rate_limited": self.n_rate_limited,
+            "concurrency": int(self.concurrency),
+        }
@@ -0,0 +1,236 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS runs ("
+    "run_id INTEGER PRIMARY KEY, model TEXT NOT NULL, dataset TEXT NOT NULL, "
+    "n_documents INTEGER NOT NULL, n_topics INTEGER, seed INTEGER, run_tag TEXT NOT NULL, "
+    "run INTEGER NOT NULL, config TEXT NOT NULL, created REAL NOT NULL, "
+    "cost_usd REAL, total_tokens INTEGER, seconds REAL, "
+    "UNIQUE (model, dataset, n_documents, n_topics, seed, run_tag, run))",
+    "CREATE TABLE IF NOT EXISTS scores ("
+    "run_id INTEGER NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE, "
+    "metric_name TEXT NOT NULL, score REAL, num_topics INTEGER, ci_low REAL, ci_high REAL)",
+    "CREATE TABLE IF NOT EXISTS assignments ("
+    "run_id INTEGER NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE, "
+    "document INTEGER NOT NULL, topic INTEGER, topic_name TEXT, ground_truth TEXT)",
+    "CREATE TABLE IF NOT EXISTS ledger ("
+    "run_id INTEGER NOT NULL REFERENCES runs (run_id) ON DELETE CASCADE, "
+    "phase TEXT, model TEXT, requests INTEGER, cache_hits INTEGER, retries INTEGER, "
+    "prompt_tokens INTEGER, cached_tokens INTEGER, completion_tokens INTEGER, "
+    "latency_seconds REAL, statuses TEXT, cost_usd REAL)",
+    "CREATE INDEX IF NOT EXISTS scores_run ON scores (run_id)",
+    "CREATE INDEX IF NOT EXISTS assignments_run ON assignments (run_id)",
+    "CREATE INDEX IF NOT EXISTS ledger_run ON ledger (run_id)",
+]
+LEDGER_COLUMNS = [
+    "phase",
+    "model",
+    "requests",
+    "cache_hits",
+    "retries",
+    "prompt_tokens",
+    "cached_tokens",
+    "completion_tokens",
+    "latency_seconds",
+    "statuses",
+    "cost_usd",
+]
+
+
+class ResultsStore:
+    """Append-only store of every run's scores, document assignments, ledger and config.
+
+    All results live in one SQLite file in WAL mode; each run is written in a single
+    transaction, so readers never see half a run. Running the same model, dataset,
+    size, topic count, seed, tag and run number again replaces the earlier result.
+    """
+
+    def __init__(self, path="data_out/results.sqlite"):
+        self.path = path
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA foreign_keys=ON")
+            for statement in SCHEMA:
+                connection.execute(statement)
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def add_run(
+        self,
+        class_name,
+        config,
+        run,
+        scores,
+        topics,
+        topic_names,
+        ground_truth,
+        ledger_rows=(),
+        totals=None,
+        seconds=None,
+    ):
+        """Store one finished run; `scores` are the (metric_name, score, num_topics, ci_low, ci_high) rows."""
+        totals = totals or {}
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                key = (
+                    class_name,
+                    config["DATASET"],
+                    config["N_documents"],
+                    config.get("N_TOPICS"),
+                    config.get("SEED"),
+                    config.get("RUN_TAG") or "",
+                    run,
+                )
+                connection.execute(
+                    "DELETE FROM runs WHERE model = ? AND dataset = ? AND n_documents = ? "
+                    "AND n_topics IS ? AND seed IS ? AND run_tag = ? AND run = ?",
+                    key,
+                )
+                run_id = connection.execute(
+                    "INSERT INTO runs (model, dataset, n_documents, n_topics, seed, run_tag, run, "
+                    "config, created, cost_usd, total_tokens, seconds) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        *key,
+                        json.dumps(config, sort_keys=True, default=str),
+                        time.time(),
+                        totals.get("cost_usd"),
+                        totals.get("total_tokens"),
+                        seconds,
+                    ),
+                ).lastrowid
+                connection.executemany(
+                    "INSERT INTO scores VALUES (?, ?, ?, ?, ?, ?)",
+                    [(run_id, *_plain(row)) for row in scores],
+                )
+                connection.executemany(
+                    "INSERT INTO assignments VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (run_id, document, *_plain((topic, name, truth)))
+                        for document, (topic, name, truth) in enumerate(
+                            zip(topics, topic_names, ground_truth)
+                        )
+                    ],
+                )
+                connection.executemany(
+                    f"INSERT INTO ledger VALUES ({', '.join('?' * (len(LEDGER_COLUMNS) + 1))})",
+                    [(run_id, *_plain([row[c] for c in LEDGER_COLUMNS])) for row in ledger_rows],
+                )
+        return run_id
+
+    def _query(self, table, columns, model=None, dataset=None, n_documents=None, n_topics=None, seed=None, run_tag=None):
+        filters = {
+            "model": model,
+            "dataset": dataset,
+            "n_documents": n_documents,
+            "n_topics": n_topics,
+            "seed": seed,
+            "run_tag": run_tag,
+        }
+        where, parameters = [], []
+        for column, value in filters.items():
+            if value is None:
+                continue
+            values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+            where.append(f"runs.{column} IN ({', '.join('?' * len(values))})")
+            parameters.extend(values)
+        sql = (
+            "SELECT runs.model, runs.dataset, runs.n_documents, runs.n_topics, runs.seed, "
+            f"runs.run_tag, runs.run, {columns} FROM runs"
+        )
+        if table is not None:
+            sql += f" JOIN {table} ON {table}.run_id = runs.run_id"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY runs.run_id" + (f", {table}.rowid" if table is not None else "")
+        with self._lock:
+            return pd.read_sql_query(sql, self._connect(), params=parameters)
+
+    def runs(self, **filters):
+        """Return one row per stored run, with its totals and config; filters as in `scores`."""
+        return self._query(None, "runs.cost_usd, runs.total_tokens, runs.seconds, runs.config", **filters)
+
+    def scores(self, **filters):
+        """Return the scores of all runs matching the filters.
+
+        Filters are model, dataset, n_documents, n_topics, seed and run_tag; each takes a
+        value or a list of values.
+        """
+        return self._query(
+            "scores",
+            "scores.metric_name, scores.score, scores.num_topics, scores.ci_low, scores.ci_high, "
+            "runs.cost_usd, runs.total_tokens, runs.seconds",
+            **filters,
+        )
+
+    def assignments(self, **filters):
+        return self._query(
+            "assignments",
+            "assignments.document, assignments.topic, assignments.topic_name, assignments.ground_truth",
+            **filters,
+        )
+
+    def ledger(self, **filters):
+        """Return the ledger rows of the matching runs; the LLM of each row is in column llm_model."""
+        columns = [
+            "ledger.model AS llm_model" if column == "model" else f"ledger.{column}"
+            for column in LEDGER_COLUMNS
+        ]
+        return self._query("ledger", ", ".join(columns), **filters)
+
+    def count_runs(self, **filters):
+        return len(self.runs(**filters))
+
+    def export_csv(self, directory="data_out", **filters):
+        """Write the legacy coherence_scores, topic_names and ledger CSVs of the matching runs.
+
+        One file of each kind is written per model, size, dataset and run tag, in the
+        layout `TopicModelingInterface.run` used to write, so existing notebooks keep working.
+        """
+        exports = {
+            "coherence_scores": (
+                self.scores(**filters),
+                ["metric_name", "score", "num_topics", "ci_low", "ci_high", "run", "cost_usd", "total_tokens", "seconds"],
+            ),
+            "topic_names": (
+                self.assignments(**filters),
+                ["topic_name", "topic", "ground_truth", "run"],
+            ),
+            "ledger": (
+                self.ledger(**filters),
+                ["run", *["llm_model" if c == "model" else c for c in LEDGER_COLUMNS]],
+            ),
+        }
+        paths = []
+        for kind, (df, columns) in exports.items():
+            for (model, n_documents, dataset, run_tag), group in df.groupby(
+                ["model", "n_documents", "dataset", "run_tag"], sort=False
+            ):
+                tag = f"_{run_tag}" if run_tag else ""
+                path = os.path.join(directory, f"{kind}_{model}_{n_documents}_{dataset}{tag}.csv")
+                group = group[columns].rename(columns={"llm_model": "model"})
+                group.reset_index(drop=True).to_csv(path)
+                paths.append(path)
+        return paths
+
+
+def _plain(values):
+    """Convert numpy scalars to Python values that sqlite3 can store."""
+    return tuple(value.item() if hasattr(value, "item") else value for value in values)
@@ -0,0 +1,131 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+from gensim.parsing.preprocessing import STOPWORDS
+from gensim.utils import simple_preprocess
+
+from Auxiliary import logger
+
+# bump when the pipeline changes, so stored token lists of the old pipeline are not reused
+PIPELINE_VERSION = "simple_preprocess-stopwords-wordnet-1"
+LEMMA_CACHE_SIZE = 200_000
+
+_lemmatizer = None
+
+
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def lemmatize(token):
+    """Lemmatize one token; a corpus has far fewer distinct tokens than occurrences, so this is cached."""
+    global _lemmatizer
+    if _lemmatizer is None:
+        from nltk.stem import WordNetLemmatizer
+
+        _lemmatizer = WordNetLemmatizer()
+    return _lemmatizer.lemmatize(token)
+
+
+def iter_tokens(text):
+    """Yields the lemmatized tokens of `text` that are not stopwords, in one pass."""
+    for token in simple_preprocess(text):
+        if token not in STOPWORDS:
+            yield lemmatize(token)
+
+
+def preprocess_chunk(texts):
+    return [list(iter_tokens(text)) for text in texts]
+
+
+def document_key(text):
+    return hashlib.sha256(f"{PIPELINE_VERSION}\0{text}".encode("utf-8")).hexdigest()
+
+
+class TokenStore:
+    """On-disk store of preprocessed token lists keyed by document hash, in one SQLite file.
+
+    Tokens produced by `simple_preprocess` contain no spaces, so each list is stored as
+    one space-separated string.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, tokens TEXT NOT NULL)"
+            )
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def get_many(self, keys):
+        """Returns {key: tokens} for the keys that are stored."""
+        found = {}
+        with self._lock:
+            connection = self._connect()
+            unique = list(dict.fromkeys(keys))
+            # stay below SQLite's limit on the number of query parameters
+            for start in range(0, len(unique), 500):
+                batch = unique[start : start + 500]
+                rows = connection.execute(
+                    f"SELECT key, tokens FROM tokens WHERE key IN ({', '.join('?' * len(batch))})",
+                    batch,
+                )
+                found.update((key, tokens.split()) for key, tokens in rows)
+        return found
+
+    def set_many(self, items):
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO tokens VALUES (?, ?)",
+                    [(key, " ".join(tokens)) for key, tokens in items],
+                )
+
+
+def preprocess_corpus(texts, store_path="cache/lda_tokens.sqlite", processes=None, chunk_size=1_000):
+    """This function tokenizes, removes stopwords from and lemmatizes every text.
+
+    Token lists already in the store at `store_path` are reused, so documents shared
+    with earlier runs are not processed again. The remaining texts are processed in
+    chunks of `chunk_size` on a pool of `processes` processes (default: all cores),
+    or in this process if they fit in one chunk. With `store_path=None` nothing is stored.
+    """
+    keys = [document_key(text) for text in texts]
+    store = TokenStore(store_path) if store_path else None
+    known = store.get_many(keys) if store is not None else {}
+
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in known:
+            missing.setdefault(key, text)
+    if missing:
+        missing_keys, missing_texts = list(missing), list(missing.values())
+        chunks = [
+            missing_texts[start : start + chunk_size]
+            for start in range(0, len(missing_texts), chunk_size)
+        ]
+        processes = min(processes or os.cpu_count(), len(chunks))
+        if processes > 1:
+            with ProcessPoolExecutor(processes) as pool:
+                processed = [tokens for chunk in pool.map(preprocess_chunk, chunks) for tokens in chunk]
+        else:
+            processed = [tokens for chunk in chunks for tokens in preprocess_chunk(chunk)]
+        known.update(zip(missing_keys, processed))
+        if store is not None:
+            store.set_many(zip(missing_keys, processed))
+    logger.info(f"Preprocessed {len(missing)} documents, reused {len(texts) - len(missing)}")
+    return [known[key] for key in keys]
@@ -0,0 +1,123 @@
+import hashlib
+import os
+
+import numpy as np
+
+from Auxiliary import logger
+
+
+def content_hashes(texts):
+    """This function returns a 64-bit content hash for every document."""
+    return np.array(
+        [
+            int.from_bytes(
+                hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little"
+            )
+            for text in texts
+        ],
+        dtype=np.uint64,
+    )
+
+
+def file_fingerprint(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def count_tokens(texts, encoding, batch_size=2_000, num_threads=None):
+    """This function counts the tokens of every document with tiktoken's multi-threaded batch encoder."""
+    num_threads = num_threads or os.cpu_count() or 1
+    counts = np.empty(len(texts), dtype=np.int32)
+    for start in range(0, len(texts), batch_size):
+        batch = encoding.encode_batch(
+            texts[start : start + batch_size], num_threads=num_threads
+        )
+        counts[start : start + len(batch)] = [len(tokens) for tokens in batch]
+    return counts
+
+
+class TokenIndex:
+    """Per-dataset sidecar with the token count, content hash and label id of each document.
+
+    The index is stored as an .npz file in `index_dir` and rebuilt whenever the
+    fingerprint of the source changes: the SHA-256 of the CSV file, or, for
+    datasets without a file, a hash over the document content hashes.
+    """
+
+    def __init__(self, token_counts, hashes, labels, fingerprint):
+        self.token_counts = token_counts
+        self.hashes = hashes
+        self.labels = labels
+        self.fingerprint = fingerprint
+
+    def __len__(self):
+        return len(self.token_counts)
+
+    def mask(self, token_limit):
+        """Boolean mask of the non-empty documents below `token_limit` tokens."""
+        return (self.token_counts > 0) & (self.token_counts < token_limit)
+
+    @staticmethod
+    def path_for(name, encoding_name, index_dir="data_in"):
+        return os.path.join(index_dir, f"{name.lower()}_{encoding_name}.tokens.npz")
+
+    @classmethod
+    def load_or_build(
+        cls,
+        name,
+        texts,
+        labels,
+        source_path=None,
+        encoding_name="cl100k_base",
+        index_dir="data_in",
+    ):
+        path = cls.path_for(name, encoding_name, index_dir)
+        hashes = None
+        if source_path is not None:
+            fingerprint = file_fingerprint(source_path)
+        else:
+            hashes = content_hashes(texts)
+            fingerprint = hashlib.sha256(hashes.tobytes()).hexdigest()
+
+        if os.path.exists(path):
+            with np.load(path) as stored:
+                if str(stored["fingerprint"]) == fingerprint and len(
+                    stored["token_counts"]
+                ) == len(texts):
+                    return cls(
+                        stored["token_counts"],
+                        stored["hashes"],
+                        stored["labels"],
+                        fingerprint,
+                    )
+            logger.info(f"Token index {path} is stale, rebuilding")
+
+        import tiktoken
+
+        logger.info(f"Building token index for {name} ({len(texts)} documents)")
+        if hashes is None:
+            hashes = content_hashes(texts)
+        index = cls(
+            count_tokens(list(texts), tiktoken.get_encoding(encoding_name)),
+            hashes,
+            np.asarray(labels, dtype=np.int32),
+            fingerprint,
+        )
+        index.save(path)
+        return index
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(
+                f,
+                token_counts=self.token_counts,
+                hashes=self.hashes,
+                labels=self.labels,
+                fingerprint=np.array(self.fingerprint),
+            )
+        os.replace(tmp_path, path)